@@ -1,17 +1,41 @@
+import json
 import os
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, url_for,
+    jsonify, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from assets import Assets
+from caching import LRUCache, TieredCache, backend_from_url
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtection, EditProfileForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
+from fragments import MessageCards, like_count
+from http_caching import apply_caching_policy, conditional
+from instrumentation import instrument
+from like_buffer import LikeBuffer
+from metrics import PROMETHEUS_CONTENT_TYPE, render_prometheus
+from models import (
+    db, connect_db, User, CachedUser, Message, Like, Follows, HomeTimeline,
+    with_authors, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
+from pagination import (
+    decode_cursor, decode_rank_cursor, keyset_page, keyset_page_by)
+from passwords import HasherBusy
+from ratelimit import RateLimiter, store_from_url
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+BUSY_MESSAGE = "We're very busy right now. Please try again in a moment."
+RATE_LIMITED_MESSAGE = "Too many login attempts. Please try again later."
+
+# Most message ids accepted by one GET /user-likes?ids=... lookup
+MAX_LIKED_LOOKUP_IDS = 200
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -22,34 +46,236 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# Authors with more followers than this aren't fanned out into home timelines
+# on write; their messages are merged into the feed when it is read.
+app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = int(
+    os.environ.get('CELEBRITY_FOLLOWER_THRESHOLD', 10000))
+app.config['MESSAGES_PER_PAGE'] = int(
+    os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 30))
+app.config['LIKED_IDS_CACHE_SIZE'] = int(
+    os.environ.get('LIKED_IDS_CACHE_SIZE', 10000))
+app.config['LIKED_IDS_CACHE_TTL'] = int(
+    os.environ.get('LIKED_IDS_CACHE_TTL', 60))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+# Optional cache shared between processes: "memory://" (in-process stand-in)
+# or a redis:// URL. When set it replaces the process-local caches, so an
+# invalidation reaches every process at once. Unset means process-local only.
+app.config['USER_CACHE_URL'] = os.environ.get('USER_CACHE_URL', '')
+# bcrypt work factor for new password hashes; older hashes are upgraded on
+# the owner's next login.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Password hashing runs in this many worker processes (0: on the request
+# thread). When PASSWORD_HASH_QUEUE_SIZE hashes are already waiting or
+# running, logins and signups wait up to PASSWORD_HASH_QUEUE_TIMEOUT seconds
+# for a slot and are then turned away.
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE_SIZE',
+                   4 * app.config['PASSWORD_HASH_WORKERS'] or 1))
+app.config['PASSWORD_HASH_QUEUE_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT', 1))
+# Login attempts allowed per client IP, and failed logins per username: a
+# burst of up to CAPACITY, refilling at PER_MINUTE.
+app.config['LOGIN_IP_CAPACITY'] = int(os.environ.get('LOGIN_IP_CAPACITY', 20))
+app.config['LOGIN_IP_PER_MINUTE'] = float(
+    os.environ.get('LOGIN_IP_PER_MINUTE', 10))
+app.config['LOGIN_USERNAME_CAPACITY'] = int(
+    os.environ.get('LOGIN_USERNAME_CAPACITY', 5))
+app.config['LOGIN_USERNAME_PER_MINUTE'] = float(
+    os.environ.get('LOGIN_USERNAME_PER_MINUTE', 1))
+# Where the rate limit buckets live: unset or "memory://" for this process
+# only, or a redis:// URL to share them between processes.
+app.config['RATE_LIMIT_URL'] = os.environ.get('RATE_LIMIT_URL', '')
+# Reverse proxies in front of the app. Login limits go by client IP, so
+# with PROXY_HOPS set the IP (and scheme and host) are taken from that many
+# X-Forwarded-* hops. Leave at 0 unless every request comes through the
+# proxies, or clients can pick their own IP.
+app.config['PROXY_HOPS'] = int(os.environ.get('PROXY_HOPS', 0))
+# Usernames that logins found don't exist, so repeats skip the database
+# (only with USER_CACHE_URL set).
+app.config['UNKNOWN_USERNAMES_CACHE_SIZE'] = int(
+    os.environ.get('UNKNOWN_USERNAMES_CACHE_SIZE', 10000))
+app.config['UNKNOWN_USERNAMES_CACHE_TTL'] = int(
+    os.environ.get('UNKNOWN_USERNAMES_CACHE_TTL', 60))
+# Memory (in bytes) for rendered message cards; 0 renders them every time.
+app.config['MESSAGE_CARD_CACHE_BYTES'] = int(
+    os.environ.get('MESSAGE_CARD_CACHE_BYTES', 32 * 1024 * 1024))
+# Set LIKE_WRITE_BEHIND=1 to record likes in memory (and a journal in
+# LIKE_JOURNAL_DIR) and write them in batches: every LIKE_FLUSH_INTERVAL
+# seconds, or once LIKE_FLUSH_SIZE are waiting. Past LIKE_BUFFER_SIZE
+# waiting, likes are written straight away again.
+app.config['LIKE_WRITE_BEHIND'] = (
+    os.environ.get('LIKE_WRITE_BEHIND', '') not in ('', '0'))
+app.config['LIKE_BUFFER_SIZE'] = int(
+    os.environ.get('LIKE_BUFFER_SIZE', 10000))
+app.config['LIKE_FLUSH_INTERVAL'] = float(
+    os.environ.get('LIKE_FLUSH_INTERVAL', 1))
+app.config['LIKE_FLUSH_SIZE'] = int(os.environ.get('LIKE_FLUSH_SIZE', 500))
+app.config['LIKE_JOURNAL_DIR'] = os.environ.get('LIKE_JOURNAL_DIR', '')
 toolbar = DebugToolbarExtension(app)
 
+if app.config['PROXY_HOPS']:
+    hops = app.config['PROXY_HOPS']
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
 connect_db(app)
+instrument(app)
+apply_caching_policy(app)
+
+# Fingerprinted, precompressed static files from `flask assets build`.
+assets = Assets(app)
+
+# Renders message lists, reusing each card's viewer-independent HTML.
+message_cards = MessageCards(app)
+
+# Ids of the messages each user has liked, keyed by user id. Shares the
+# user cache's backend, so a like invalidates the set in every process.
+liked_ids_cache = TieredCache(
+    LRUCache(
+        maxsize=app.config['LIKED_IDS_CACHE_SIZE'],
+        ttl=app.config['LIKED_IDS_CACHE_TTL']),
+    shared=backend_from_url(app.config['USER_CACHE_URL']),
+    prefix='liked-ids:',
+    dumps=lambda ids: json.dumps(sorted(ids)),
+    loads=lambda data: frozenset(json.loads(data)))
+
+# CachedUser snapshots, keyed by user id.
+user_cache = TieredCache(
+    LRUCache(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL']),
+    shared=backend_from_url(app.config['USER_CACHE_URL']),
+    prefix='user:',
+    dumps=CachedUser.to_json,
+    loads=CachedUser.from_json)
+
+# Usernames known not to exist, for User.authenticate. Only kept in a shared
+# cache: a process-local copy wouldn't hear about a signup handled by
+# another process, and would turn the new user away until it expired.
+unknown_usernames = None
+if app.config['USER_CACHE_URL']:
+    unknown_usernames = TieredCache(
+        LRUCache(
+            maxsize=app.config['UNKNOWN_USERNAMES_CACHE_SIZE'],
+            ttl=app.config['UNKNOWN_USERNAMES_CACHE_TTL']),
+        shared=backend_from_url(app.config['USER_CACHE_URL']),
+        prefix='unknown-username:',
+        dumps=json.dumps,
+        loads=json.loads)
+
+rate_limit_store = store_from_url(app.config['RATE_LIMIT_URL'])
+
+login_ip_limiter = RateLimiter(
+    rate_limit_store,
+    prefix='login-ip:',
+    capacity=app.config['LOGIN_IP_CAPACITY'],
+    per_minute=app.config['LOGIN_IP_PER_MINUTE'])
+
+login_username_limiter = RateLimiter(
+    rate_limit_store,
+    prefix='login-username:',
+    capacity=app.config['LOGIN_USERNAME_CAPACITY'],
+    per_minute=app.config['LOGIN_USERNAME_PER_MINUTE'])
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+def get_cached_user(user_id):
+    """Return a CachedUser for `user_id` (None if there is no such user),
+    querying the database only on a cache miss.
+    """
+
+    cached_user = user_cache.get(user_id)
+
+    if cached_user is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+
+        cached_user = user.snapshot()
+        user_cache.set(user_id, cached_user)
+
+    return cached_user
+
+
+def invalidate_users(*user_ids):
+    """Drop cached snapshots after their profile fields or counters change."""
+
+    user_cache.delete(*user_ids)
+
+
+def forget_likes(user_ids):
+    """Drop cached likes and snapshots of users whose buffered likes were
+    just written.
+    """
+
+    for user_id in user_ids:
+        liked_ids_cache.delete(user_id)
+
+    invalidate_users(*user_ids)
+
+
+# Write-behind buffer for likes, when LIKE_WRITE_BEHIND is set.
+like_buffer = LikeBuffer(app, on_flushed=forget_likes)
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user (a CachedUser) to Flask global."""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_cached_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
+    # Loaded on first use by get_liked_message_ids
+    g.pop('user_liked_messages', None)
+
 @app.before_request
 def add_csrf_to_g():
     """Adds CSRF Form to flask global."""
     g.csrf_form = CSRFProtection()
 
-@app.before_request
-def add_liked_messages_to_g():
-    """Adds ids of liked messages to flask global."""
-    if CURR_USER_KEY in session:
-        g.user_liked_messages = {msg.id for msg in g.user.liked_messages}
+def get_liked_message_ids():
+    """Return the ids of messages liked by the current user.
+
+    Loaded at most once per request, from the per-user cache if possible.
+    """
+
+    if 'user_liked_messages' not in g:
+        liked_ids = liked_ids_cache.get(g.user.id)
+
+        if liked_ids is None:
+            liked_ids = Like.message_ids_for(g.user.id)
+            liked_ids_cache.set(g.user.id, liked_ids)
+
+        g.user_liked_messages = like_buffer.apply_pending(
+            g.user.id, liked_ids)
+
+    return g.user_liked_messages
+
+
+def liked_ids_among(message_ids):
+    """Return which of `message_ids` the current user has liked.
+
+    Answered from the cached liked-id set when there is one, otherwise with
+    a single query scoped to these ids.
+    """
+
+    liked_ids = liked_ids_cache.get(g.user.id)
+
+    if liked_ids is not None:
+        liked_ids = liked_ids.intersection(message_ids)
+    else:
+        liked_ids = Like.liked_among(g.user.id, message_ids)
+
+    return like_buffer.apply_pending(g.user.id, liked_ids, message_ids)
 
 @app.before_request
 def add_message_form_to_g():
@@ -71,6 +297,18 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def get_before_cursor():
+    """Return the decoded ?before= pagination cursor, or None.
+
+    Aborts with 400 if the cursor is malformed.
+    """
+
+    try:
+        return decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -96,11 +334,17 @@ def signup():
                 image_url=form.image_url.data or DEFAULT_IMAGE_URL
             )
             db.session.commit()
+            if unknown_usernames is not None:
+                unknown_usernames.delete(user.username)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -116,15 +360,37 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(
-            form.username.data,
-            form.password.data)
+        username = form.username.data
+
+        # Turn away floods before they cost a database query or a hash.
+        # Every attempt spends from the IP's bucket, checked first so one
+        # IP can't fill the store with buckets for made-up usernames. Only
+        # failures spend from the username's bucket. That still means
+        # LOGIN_USERNAME_CAPACITY wrong guesses lock the username, owner
+        # included, out until it refills: the price of capping guesses
+        # spread over many IPs.
+        if (not login_ip_limiter.allow(request.remote_addr)
+                or login_username_limiter.blocked(username.lower())):
+            flash(RATE_LIMITED_MESSAGE, 'danger')
+            return render_template('users/login.html', form=form), 429
+
+        try:
+            user = User.authenticate(
+                username,
+                form.password.data,
+                unknown_usernames=unknown_usernames)
+        except HasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # Saves the password if it was rehashed
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        login_username_limiter.allow(username.lower())
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
@@ -151,9 +417,10 @@ def logout():
 
 @app.get('/users')
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, in username order.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and an
+    'after' param (a username) to continue from the previous page.
     """
 
     if not g.user:
@@ -161,16 +428,79 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    after = request.args.get('after')
+    per_page = app.config['USERS_PER_PAGE']
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.search(search) if search else User.query
+
+    if after:
+        users = users.filter(User.username > after)
+
+    users = users.order_by(User.username).limit(per_page + 1).all()
 
-    return render_template('users/index.html', users=users)
+    next_after = None
+    if len(users) > per_page:
+        users = users[:per_page]
+        next_after = users[-1].username
+
+    return render_template(
+        'users/index.html',
+        users=users,
+        search=search,
+        next_after=next_after,
+        following_ids=g.user.following_ids_among([user.id for user in users]))
+
+
+@app.get('/api/users/typeahead')
+def users_typeahead():
+    """Returns json with users whose username starts with the 'q' param."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    prefix = request.args.get('q', '')
+
+    if not prefix:
+        return jsonify(users=[])
+
+    return jsonify(users=[user.serialize() for user in User.typeahead(prefix)])
+
+
+def pending_likes_version():
+    """ETag part for the current user's buffered likes, which don't bump
+    their version until they are written.
+    """
+
+    return sorted(like_buffer.pending_for(g.user.id).items())
+
+
+def user_page_versions(user_id):
+    """ETag parts for a page about `user_id`, as seen by the current user."""
+
+    if not g.user:
+        return None
+
+    versions = User.versions(g.user.id, user_id)
+
+    # The page shows its messages' like counts, which others' likes change
+    like_counts, _ = keyset_page(
+        db.session.query(Message.timestamp, Message.id, Message.like_count)
+        .filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        get_before_cursor(),
+        app.config['MESSAGES_PER_PAGE'])
+
+    return (
+        versions.get(g.user.id),
+        versions.get(user_id),
+        [tuple(row) for row in like_counts],
+        pending_likes_version(),
+    )
 
 
 @app.get('/users/<int:user_id>')
+@conditional(user_page_versions)
 def show_user(user_id):
     """Show user profile."""
 
@@ -179,8 +509,40 @@ def show_user(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    messages, next_cursor = user_messages_page(user.id)
+
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_among([msg.id for msg in messages]))
+
 
-    return render_template('users/show.html', user=user)
+def user_messages_page(user_id):
+    """Return a page of messages written by `user_id` and the next cursor."""
+
+    return keyset_page(
+        Message.query.filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        get_before_cursor(),
+        app.config['MESSAGES_PER_PAGE'])
+
+
+@app.get('/api/users/<int:user_id>/messages')
+def show_user_messages_json(user_id):
+    """Return json with a page of messages written by this user."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+    messages, next_cursor = user_messages_page(user_id)
+
+    return jsonify(
+        messages=[msg.serialize() for msg in messages],
+        nextCursor=next_cursor)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -192,7 +554,13 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = user.following
+    return render_template(
+        'users/following.html',
+        user=user,
+        following=following,
+        following_ids=g.user.following_ids_among(
+            [followed_user.id for followed_user in following]))
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -204,7 +572,50 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = user.followers
+    return render_template(
+        'users/followers.html',
+        user=user,
+        followers=followers,
+        following_ids=g.user.following_ids_among(
+            [follower.id for follower in followers]))
+
+
+def follow_user(follow_id):
+    """Make the current user follow `follow_id`, keeping counters and the
+    home timeline in step. Does nothing if they already follow them; 404 if
+    there is no such user.
+    """
+
+    if not Follows.add(g.user.id, follow_id):
+        if not db.session.query(
+                User.query.filter(User.id == follow_id).exists()).scalar():
+            abort(404)
+        return
+
+    User.bump_counts(g.user.id, following_count=1)
+    User.bump_counts(follow_id, followers_count=1)
+    HomeTimeline.backfill(
+        g.user.id,
+        follow_id,
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
+    db.session.commit()
+    invalidate_users(g.user.id, follow_id)
+
+
+def unfollow_user(follow_id):
+    """Make the current user stop following `follow_id`, keeping counters
+    and the home timeline in step. Does nothing if they weren't following.
+    """
+
+    if Follows.remove(g.user.id, follow_id):
+        User.bump_counts(g.user.id, following_count=-1)
+        User.bump_counts(follow_id, followers_count=-1)
+        HomeTimeline.prune(g.user.id, follow_id)
+        HomeTimeline.queue_backfills(
+            [follow_id], app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
+        db.session.commit()
+        invalidate_users(g.user.id, follow_id)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -218,9 +629,7 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    follow_user(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -236,13 +645,35 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    unfollow_user(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.post('/api/users/follow/<int:follow_id>')
+def start_following_json(follow_id):
+    """Follow a user; return json with the new follow state."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    follow_user(follow_id)
+
+    return jsonify(userId=follow_id, following=True)
+
+
+@app.post('/api/users/stop-following/<int:follow_id>')
+def stop_following_json(follow_id):
+    """Stop following a user; return json with the new follow state."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    unfollow_user(follow_id)
+
+    return jsonify(userId=follow_id, following=False)
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -251,11 +682,17 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = g.user
+    user = User.query.get_or_404(g.user.id)
     form = EditProfileForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        try:
+            password_ok = user.check_password(form.password.data)
+        except HasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template("users/edit.html", form=form), 503
+
+        if password_ok:
 
             user.username = form.username.data
             user.email = form.email.data
@@ -263,9 +700,13 @@ def profile():
             user.header_image_url = form.header_image_url.data or DEFAULT_HEADER_IMAGE_URL
             user.location = form.location.data
             user.bio = form.bio.data
+            user.profile_version += 1
 
             db.session.add(user)
             db.session.commit()
+            invalidate_users(user.id)
+            if unknown_usernames is not None:
+                unknown_usernames.delete(user.username)
             flash("Information successfully updated.", "success")
             return redirect(f'/users/{user.id}')
 
@@ -276,9 +717,49 @@ def profile():
 
 @app.get("/users/<int:user_id>/likes")
 def get_user_likes(user_id):
-    """Display list of all messages liked by user id"""
+    """Display a page of messages liked by user id"""
     user = User.query.get_or_404(user_id)
-    return render_template('users/liked-messages.html', messages=user.liked_messages, user=user)
+    messages, next_cursor = liked_messages_page(user.id)
+    return render_template(
+        'users/liked-messages.html',
+        messages=messages,
+        user=user,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_among([msg.id for msg in messages]))
+
+
+def liked_messages_page(user_id):
+    """Return a page of messages liked by `user_id`, most recently liked
+    first, and the next cursor.
+
+    Pages on when the messages were liked, so each page reads its slice of
+    ix_likes_user_id_created_at instead of sorting all the user's likes.
+    """
+
+    return keyset_page_by(
+        with_authors(
+            Message.query
+            .join(Like, Like.message_id == Message.id)
+            .filter(Like.user_id == user_id)),
+        Like.created_at,
+        Like.message_id,
+        get_before_cursor(),
+        app.config['MESSAGES_PER_PAGE'])
+
+
+@app.get("/api/users/<int:user_id>/likes")
+def get_user_likes_json(user_id):
+    """Return json with a page of messages liked by user id"""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+    messages, next_cursor = liked_messages_page(user_id)
+
+    return jsonify(
+        messages=[msg.serialize() for msg in messages],
+        nextCursor=next_cursor)
 
 
 @app.post('/users/delete')
@@ -294,8 +775,18 @@ def delete_user():
 
     do_logout()
 
+    followed_ids = [
+        user_id for (user_id,) in (
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == g.user.id)
+        )
+    ]
+    others = User.uncount_user(g.user.id)
     User.query.filter(User.id == g.user.id).delete()
+    HomeTimeline.queue_backfills(
+        followed_ids, app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
     db.session.commit()
+    invalidate_users(g.user.id, *others)
 
     flash("Your account has been deleted.", "success")
     return redirect("/signup")
@@ -321,14 +812,102 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.bump_counts(g.user.id, messages_count=1)
+        HomeTimeline.fan_out(msg, app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
         db.session.commit()
+        invalidate_users(g.user.id)
 
         return redirect(current_url)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Page of messages matching the 'q' param in querystring, best match
+    first, continuing from the ?before= cursor if given.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q', '').strip()
+    messages, next_cursor = search_messages_page(search)
+
+    return render_template(
+        'messages/search.html',
+        search=search,
+        messages=messages,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_among([msg.id for msg in messages]))
+
+
+def search_messages_page(search):
+    """Return a page of messages matching `search` and the next cursor."""
+
+    if not search:
+        return [], None
+
+    try:
+        before = decode_rank_cursor(request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    return Message.search(
+        search,
+        before=before,
+        per_page=app.config['MESSAGES_PER_PAGE'])
+
+
+@app.get('/api/messages/search')
+def search_messages_json():
+    """Return json with a page of messages matching the 'q' param."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages, next_cursor = search_messages_page(
+        request.args.get('q', '').strip())
+
+    return jsonify(
+        messages=[msg.serialize() for msg in messages],
+        nextCursor=next_cursor)
+
+
+def message_page_versions(message_id):
+    """ETag parts for a message's page, as seen by the current user.
+
+    A message's text never changes, so the page only changes with its
+    author, the viewer or its like count.
+    """
+
+    if not g.user:
+        return None
+
+    author_id = (
+        db.select(Message.user_id)
+        .where(Message.id == message_id)
+        .scalar_subquery())
+    message_like_count = (
+        db.select(Message.like_count)
+        .where(Message.id == message_id)
+        .scalar_subquery())
+    versions = (
+        db.session.query(
+            User.id, User.profile_version, User.version, message_like_count)
+        .filter(User.id.in_([g.user.id, author_id])))
+
+    return (
+        message_id,
+        sorted(tuple(row) for row in versions),
+        pending_likes_version(),
+    )
+
+
 @app.get('/messages/<int:message_id>')
+@conditional(message_page_versions)
 def show_message(message_id):
     """Show a message."""
 
@@ -336,8 +915,67 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = with_authors(Message.query).get_or_404(message_id)
+    return render_template(
+        'messages/show.html',
+        message=msg,
+        like_count=like_count(msg),
+        liked_ids=liked_ids_among([msg.id]))
+
+
+def likers_page(message_id):
+    """Return a page of the users who liked `message_id` (404 if there is
+    no such message) and the user id to continue after.
+
+    Takes an 'after' param (a user id) from the querystring; 400 if it is
+    malformed.
+    """
+
+    if not db.session.query(
+            Message.query.filter(Message.id == message_id).exists()).scalar():
+        abort(404)
+
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            abort(400)
+
+    return Like.likers(message_id, after, app.config['USERS_PER_PAGE'])
+
+
+@app.get('/messages/<int:message_id>/likers')
+def show_likers(message_id):
+    """Show the users who liked a message, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    likers, next_after = likers_page(message_id)
+
+    return render_template(
+        'users/index.html',
+        users=likers,
+        next_after=next_after,
+        following_ids=g.user.following_ids_among([user.id for user in likers]))
+
+
+@app.get('/api/messages/<int:message_id>/likers')
+def show_likers_json(message_id):
+    """Return json with a page of the users who liked a message:
+    {users, nextAfter}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    likers, next_after = likers_page(message_id)
+
+    return jsonify(
+        users=[user.serialize() for user in likers],
+        nextAfter=next_after)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -348,6 +986,9 @@ def delete_message(message_id):
     Redirect to user page on success. If the message was not
     created by the currently logged in user, redirect to the
     homepage.
+
+    Home timeline rows for the message are removed by the database
+    (ON DELETE CASCADE on home_timeline.message_id).
     """
 
     if not g.user:
@@ -360,8 +1001,11 @@ def delete_message(message_id):
         flash("You cannot delete someone else's message!", "danger")
         return redirect("/")
 
+    User.bump_counts(g.user.id, messages_count=-1)
+    likers = User.uncount_likes([msg.id])
     db.session.delete(msg)
     db.session.commit()
+    invalidate_users(g.user.id, *likers)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -375,71 +1019,187 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the most recent messages of followed_users,
+      continuing from the ?before= cursor if given
     """
 
     if g.user:
-        showing_ids = [following.id for following in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(showing_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = home_feed_page()
 
-        return render_template('home.html', messages=messages)
+        return render_template(
+            'home.html',
+            messages=messages,
+            next_cursor=next_cursor,
+            liked_ids=liked_ids_among([msg.id for msg in messages]))
 
     else:
         return render_template('home-anon.html')
 
+
+def home_feed_page():
+    """Return a page of the current user's home feed and the next cursor."""
+
+    return HomeTimeline.feed(
+        g.user.id,
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'],
+        before=get_before_cursor(),
+        per_page=app.config['MESSAGES_PER_PAGE'])
+
+
+@app.get('/api/feed')
+def show_feed_json():
+    """Return json with a page of the current user's home feed."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages, next_cursor = home_feed_page()
+
+    return jsonify(
+        messages=[msg.serialize() for msg in messages],
+        nextCursor=next_cursor)
+
 ##############################################################################
 # Liked messages
 
 @app.get("/user-likes")
 def show_user_likes():
-    """Returns json with users liked messages"""
+    """Returns json with users liked messages.
 
-    return jsonify(userLikes=list(g.user_liked_messages))
+    Can take an 'ids' param in querystring (comma-separated message ids) to
+    return only which of those messages are liked.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    ids = request.args.get('ids')
+
+    if ids is None:
+        return jsonify(userLikes=list(get_liked_message_ids()))
+
+    try:
+        message_ids = {int(id) for id in ids.split(',') if id}
+    except ValueError:
+        abort(400)
+
+    if len(message_ids) > MAX_LIKED_LOOKUP_IDS:
+        abort(400)
+
+    return jsonify(userLikes=sorted(liked_ids_among(message_ids)))
 
 
 @app.post("/messages/<int:message_id>/like")
 def toggle_like_message(message_id):
-    """Toggles liking message for the current user."""
+    """Likes or unlikes message for the current user.
 
-    msg = Message.query.get_or_404(message_id)
+    Takes json {"liked": true|false} with the state wanted; doing the same
+    twice changes nothing. Without it the like is toggled, except with
+    LIKE_WRITE_BEHIND on: another process may be holding this user's
+    latest like, so only the state wanted can be recorded safely.
+
+    Returns json with the new state: {messageId, liked, likeCount}.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    if msg not in g.user.liked_messages:
-        g.user.liked_messages.append(msg)
+    liked = (request.get_json(silent=True) or {}).get('liked')
+
+    if liked is not None and not isinstance(liked, bool):
+        abort(400)
+
+    if liked is None:
+        if like_buffer.enabled:
+            return jsonify(
+                error='Send the state wanted: {"liked": true}.'), 400
+        toggled = Like.toggle(g.user.id, message_id)
+    elif like_buffer.enabled:
+        toggled = like_buffer.set_liked(g.user.id, message_id, liked)
     else:
-        g.user.liked_messages.remove(msg)
+        toggled = Like.set_liked(g.user.id, message_id, liked)
+
+    if toggled is None:
+        abort(404)
+
+    if toggled.author_id == g.user.id:
+        return jsonify(error="You cannot like your own post."), 403
 
     db.session.commit()
+    liked_ids_cache.delete(g.user.id)
+    invalidate_users(g.user.id)
 
-    return jsonify(messageId=message_id)
+    return jsonify(
+        messageId=message_id,
+        liked=toggled.liked,
+        likeCount=toggled.like_count)
 
 #pass in logic about whether or not msg is liked
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Metrics
+
+
+@app.get('/metrics')
+def show_metrics():
+    """Show request, query and password hashing metrics in Prometheus text
+    format.
+    """
+
+    return render_prometheus(), 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE}
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('recount')
+def recount():
+    """Rebuild the denormalized counters on users and messages from the
+    source tables.
+    """
+
+    User.recount()
+    Message.recount()
+    db.session.commit()
+    print("User and message counters rebuilt.")
+
 
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every home timeline from follows and messages."""
+
+    HomeTimeline.rebuild(app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
+    db.session.commit()
+    print("Home timelines rebuilt.")
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
 
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Copy the recent messages of authors who stopped being celebrities
+    into their followers' home timelines.
+    """
+
+    done = 0
+    while HomeTimeline.run_next_backfill(
+            app.config['CELEBRITY_FOLLOWER_THRESHOLD']) is not None:
+        db.session.commit()
+        done += 1
 
+    print(f"Backfilled home timelines for {done} authors.")
 
+
+@app.cli.command('trim-timelines')
+def trim_timelines():
+    """Cut home timelines down to their newest entries."""
+
+    removed = HomeTimeline.trim()
+    db.session.commit()
+    print(f"Removed {removed} old home timeline entries.")
+
+
+##############################################################################
 # @app.post("/messages/<int:message_id>/like")
 # def toggle_like_message(message_id):
 #     """Toggles liking message for the current user."""
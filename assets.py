@@ -0,0 +1,295 @@
+"""Built static assets for Warbler.
+
+`flask assets build` copies every file in static/ into static/dist/ under a
+name containing a hash of its contents (style.css -> style.1a2b3c4d.css):
+
+- Text files (CSS, JS, SVG, ...) also get .gz and, if the `brotli` package
+  is installed, .br copies, compressed once at build time.
+- JPEG and PNG images also get downscaled copies (e.g. warbler-hero.<hash>
+  .480w.jpg) for srcset, if the `Pillow` package is installed.
+- url("/static/...") references in CSS are pointed at the built files.
+- dist/manifest.json maps each original name to its built files.
+
+Assets serves the built files from /assets/, picking the .br or .gz copy
+when the browser's Accept-Encoding allows it. Their names change with their
+contents, so they are cached for good. `static_url`, `asset_url` and
+`image_attrs` link to them, falling back to the files in static/ when there
+is no build (or while templates auto-reload, e.g. in debug mode).
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from io import BytesIO
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+
+try:
+    import brotli
+except ImportError:  # .br copies are skipped without it
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # resized images are skipped without it
+    Image = None
+
+# Built files go in this folder under static/
+DIST_FOLDER = 'dist'
+
+# Suffixes of files worth compressing
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.json', '.txt', '.html')
+
+# Widths (in pixels) of the downscaled copies of images wider than them
+IMAGE_WIDTHS = (480, 960, 1600)
+
+# (Accept-Encoding token, file suffix), best first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Seconds built files may be cached for (a year).
+MAX_AGE = 365 * 24 * 60 * 60
+
+CSS_URL = re.compile(r'''url\((["']?)/static/([^"')]+)\1\)''')
+
+
+def _hashed_name(name, content, suffix=''):
+    digest = hashlib.blake2b(content, digest_size=4).hexdigest()
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{suffix}{ext}"
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _resize(content, width, ext):
+    """Return image `content` scaled to `width` pixels wide, re-encoded."""
+
+    with Image.open(BytesIO(content)) as image:
+        resized = image
+        if width != image.width:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+
+        out = BytesIO()
+        if ext == '.png':
+            resized.save(out, 'PNG', optimize=True)
+        else:
+            resized.convert('RGB').save(
+                out, 'JPEG', quality=80, optimize=True, progressive=True)
+
+        return out.getvalue()
+
+
+def build(static_folder, static_url_path='/static', log=print):
+    """Build static_folder/dist from the files in static_folder; return the
+    manifest.
+    """
+
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    if brotli is None:
+        log("brotli isn't installed; skipping .br files")
+    if Image is None:
+        log("Pillow isn't installed; skipping resized images")
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist)
+        for name in sorted(files):
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            sources.append(path.replace(os.sep, '/'))
+
+    # CSS last, so the files it refers to already have built names
+    sources.sort(key=lambda name: name.endswith('.css'))
+
+    manifest = {}
+    built_urls = {}
+
+    for name in sources:
+        with open(os.path.join(static_folder, name), 'rb') as f:
+            content = f.read()
+
+        ext = os.path.splitext(name)[1].lower()
+
+        if ext == '.css':
+            content = CSS_URL.sub(
+                lambda m: 'url({0}{1}{0})'.format(
+                    m[1], built_urls.get(m[2], f"{static_url_path}/{m[2]}")),
+                content.decode()).encode()
+
+        entry = {'file': _hashed_name(name, content), 'encodings': []}
+        built = content
+
+        if ext in ('.jpg', '.jpeg', '.png') and Image is not None:
+            with Image.open(BytesIO(content)) as image:
+                entry['width'] = image.width
+
+            # Re-encoding at full size often saves a lot on its own
+            recompressed = _resize(content, entry['width'], ext)
+            if len(recompressed) < len(content):
+                built = recompressed
+
+            entry['variants'] = {}
+            for width in IMAGE_WIDTHS:
+                if width < entry['width']:
+                    variant = _hashed_name(name, content, f".{width}w")
+                    _write(os.path.join(dist, variant),
+                           _resize(content, width, ext))
+                    entry['variants'][width] = variant
+
+        _write(os.path.join(dist, entry['file']), built)
+
+        if ext in COMPRESSIBLE:
+            compressed = {'gzip': gzip.compress(content, 9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(content)
+
+            for encoding, suffix in ENCODINGS:
+                # Not worth a second request path if it barely shrinks
+                data = compressed.get(encoding)
+                if data is not None and len(data) < len(content) * 0.9:
+                    _write(os.path.join(dist, entry['file'] + suffix), data)
+                    entry['encodings'].append(encoding)
+
+        manifest[name] = entry
+        built_urls[name] = f"/assets/{entry['file']}"
+
+    _write(os.path.join(dist, 'manifest.json'),
+           json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    return manifest
+
+
+class Assets:
+    """Serves and links to the files made by `flask assets build`, as a
+    Flask extension.
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.encodings = {}
+        self.directory = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = os.path.join(app.static_folder, DIST_FOLDER)
+        self.load()
+
+        app.extensions['assets'] = self
+        app.add_url_rule(
+            '/assets/<path:filename>', 'assets', self.send_asset)
+        app.add_template_global(self.url, 'asset_url')
+        app.add_template_global(self.image_attrs)
+        app.cli.add_command(assets_cli)
+
+    def load(self):
+        """Read the manifest of the last build, if there is one."""
+
+        try:
+            with open(os.path.join(self.directory, 'manifest.json')) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+        self.encodings = {
+            entry['file']: entry['encodings']
+            for entry in self.manifest.values()
+        }
+
+    def _entry(self, url):
+        """Return the manifest entry for a static filename or /static/ URL."""
+
+        if current_app.jinja_env.auto_reload:
+            return None
+
+        prefix = f"{current_app.static_url_path}/"
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+
+        return self.manifest.get(url)
+
+    def url(self, url):
+        """Return the URL of the built copy of `url` (a static filename or
+        /static/ URL), or `url` itself if there isn't one.
+        """
+
+        entry = self._entry(url or '')
+        if entry is None:
+            return url
+
+        return f"/assets/{entry['file']}"
+
+    def image_attrs(self, url, sizes='100vw'):
+        """Return src (and, if there are resized copies, srcset and sizes)
+        attributes for an <img> showing `url`.
+        """
+
+        attrs = f'src="{escape(self.url(url))}"'
+
+        entry = self._entry(url or '')
+        if entry and entry.get('variants'):
+            candidates = [
+                f"/assets/{variant} {width}w"
+                for width, variant in entry['variants'].items()
+            ]
+            candidates.append(f"/assets/{entry['file']} {entry['width']}w")
+            attrs += (f' srcset="{escape(", ".join(candidates))}"'
+                      f' sizes="{escape(sizes)}"')
+
+        return Markup(attrs)
+
+    def send_asset(self, filename):
+        """Serve a built file, precompressed if the browser accepts it."""
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = None
+
+        for encoding, suffix in ENCODINGS:
+            if (encoding in self.encodings.get(filename, ())
+                    and request.accept_encodings[encoding]):
+                response = send_from_directory(
+                    self.directory, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(
+                self.directory, filename, mimetype=mimetype)
+
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+
+@click.group('assets')
+def assets_cli():
+    """Build fingerprinted, compressed static files."""
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build_command():
+    """Build static/dist from the files in static/."""
+
+    manifest = build(
+        current_app.static_folder, current_app.static_url_path, log=click.echo)
+    current_app.extensions['assets'].load()
+
+    click.echo(f"Built {len(manifest)} assets into "
+               f"{os.path.join(current_app.static_folder, DIST_FOLDER)}")
@@ -0,0 +1,180 @@
+"""Show query plans for the feed, follows and likes access paths with and
+without the secondary indexes declared in models.py.
+
+Seeds a large synthetic dataset into DATABASE_URL (PostgreSQL only), so
+point it at a scratch database:
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.query_plans
+
+THIS DROPS AND RECREATES EVERY TABLE IN THAT DATABASE.
+"""
+
+import argparse
+import re
+from time import perf_counter
+
+from app import app, db
+from models import Follows, Like, Message
+
+INDEXES = [
+    index
+    for table in (Message.__table__, Follows.__table__, Like.__table__)
+    for index in table.indexes
+    if index.name in (
+        'ix_messages_user_id_timestamp',
+        'ix_follows_user_following_id',
+        'ix_likes_message_id',
+        'ix_likes_user_id_created_at',
+    )
+]
+
+QUERIES = {
+    "profile messages page": """
+        SELECT * FROM messages
+        WHERE user_id = :user_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 21
+    """,
+    "who does the user follow": """
+        SELECT user_being_followed_id FROM follows
+        WHERE user_following_id = :user_id
+    """,
+    "fan-out-on-read feed": """
+        SELECT * FROM messages
+        WHERE user_id IN (
+            SELECT user_being_followed_id FROM follows
+            WHERE user_following_id = :user_id)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 21
+    """,
+    "who liked the message": """
+        SELECT user_id FROM likes
+        WHERE message_id = :message_id
+    """,
+    "liked messages page": """
+        SELECT messages.* FROM messages
+        JOIN likes ON likes.message_id = messages.id
+        WHERE likes.user_id = :liker_id
+        ORDER BY likes.created_at DESC, likes.message_id DESC
+        LIMIT 21
+    """,
+}
+
+
+def seed(users, messages, follows, likes):
+    """Fill the tables with random rows using generate_series."""
+
+    db.drop_all()
+    db.create_all()
+
+    statements = [
+        ("users", """
+            INSERT INTO users (email, username, password)
+            SELECT 'user' || i || '@example.com', 'user' || i, 'x'
+            FROM generate_series(1, :users) AS i
+        """),
+        ("messages", """
+            INSERT INTO messages (text, timestamp, user_id)
+            SELECT 'message ' || i,
+                   now() - random() * interval '730 days',
+                   1 + floor(random() * :users)::int
+            FROM generate_series(1, :messages) AS i
+        """),
+        ("follows", """
+            INSERT INTO follows (user_being_followed_id, user_following_id)
+            SELECT 1 + floor(random() * :users)::int,
+                   1 + floor(random() * :users)::int
+            FROM generate_series(1, :follows)
+            ON CONFLICT DO NOTHING
+        """),
+        ("likes", """
+            INSERT INTO likes (user_id, message_id, created_at)
+            SELECT 1 + floor(random() * :users)::int,
+                   1 + floor(random() * :messages)::int,
+                   now() - random() * interval '730 days'
+            FROM generate_series(1, :likes)
+            ON CONFLICT DO NOTHING
+        """),
+    ]
+
+    params = dict(users=users, messages=messages, follows=follows, likes=likes)
+
+    for table, statement in statements:
+        start = perf_counter()
+        db.session.execute(db.text(statement), params)
+        db.session.commit()
+        print(f"Seeded {table} in {perf_counter() - start:.1f}s")
+
+
+def explain_all(params):
+    """Print the plan and execution time of every query."""
+
+    db.session.execute(db.text("ANALYZE"))
+
+    for name, query in QUERIES.items():
+        plan = [
+            line for (line,) in db.session.execute(
+                db.text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"), params)
+        ]
+        timing = next(
+            (line for line in plan if line.startswith("Execution Time")), "")
+        print(f"\n--- {name}: {re.sub(r'^Execution Time: ', '', timing)}")
+        print("\n".join(plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--follows", type=int, default=2_000_000)
+    parser.add_argument("--likes", type=int, default=2_000_000)
+    parser.add_argument(
+        "--no-seed",
+        action="store_true",
+        help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    if db.engine.dialect.name != 'postgresql':
+        parser.error("query plans are only compared on PostgreSQL")
+
+    if not args.no_seed:
+        seed(args.users, args.messages, args.follows, args.likes)
+
+    # Explain for the user who follows the most people, the most liked
+    # message and the user with the most likes, the worst cases for the
+    # missing secondary indexes.
+    params = {
+        "user_id": db.session.execute(db.text("""
+            SELECT user_following_id FROM follows
+            GROUP BY user_following_id ORDER BY count(*) DESC LIMIT 1
+        """)).scalar(),
+        "message_id": db.session.execute(db.text("""
+            SELECT message_id FROM likes
+            GROUP BY message_id ORDER BY count(*) DESC LIMIT 1
+        """)).scalar(),
+        "liker_id": db.session.execute(db.text("""
+            SELECT user_id FROM likes
+            GROUP BY user_id ORDER BY count(*) DESC LIMIT 1
+        """)).scalar(),
+    }
+
+    # Release the session's locks on the tables before altering them.
+    db.session.commit()
+
+    for index in INDEXES:
+        index.drop(db.engine, checkfirst=True)
+
+    print("\n========== Without secondary indexes ==========")
+    explain_all(params)
+    db.session.commit()
+
+    for index in INDEXES:
+        index.create(db.engine)
+
+    print("\n========== With secondary indexes ==========")
+    explain_all(params)
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,298 @@
+"""Benchmark the hot routes and compare them with a stored baseline.
+
+Generates a dataset with generator/create_csvs.py, loads it into
+DATABASE_URL with seed.py, then drives the Flask test client against the
+busiest pages, recording latency percentiles, SQL statements and memory
+allocated per request:
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.routes \\
+        --users 20000 --messages 200000 --save benchmarks/baseline.json
+
+    # later, after a change
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.routes \\
+        --no-seed --baseline benchmarks/baseline.json
+
+With --baseline it exits with status 1 if any route got slower (p95),
+started running more statements or allocating more memory than the
+baseline allows.
+
+THIS DROPS AND RECREATES EVERY TABLE IN THAT DATABASE (unless --no-seed).
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import namedtuple
+from statistics import mean, median
+from time import perf_counter
+
+from app import (
+    app, db, CURR_USER_KEY, liked_ids_cache, message_cards, rate_limit_store,
+    user_cache)
+from models import Follows, Like, Message, User
+from query_budget import QueryRecorder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Plain-text password of every generated user.
+PASSWORD = 'password'
+
+# One route to time. `data` is form data and `json` a JSON body; `reset`,
+# if given, is called before each request (untimed) to put the database
+# back in the state the request expects.
+Route = namedtuple(
+    'Route', 'method url data json logged_in reset',
+    defaults=(None, None, True, None))
+
+
+def seed(args):
+    """Generate CSVs in a scratch directory and load them with seed.py."""
+
+    import seed as loader
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run(
+            [
+                sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                '--users', str(args.users),
+                '--messages', str(args.messages),
+                '--follows', str(args.follows),
+                '--likes', str(args.likes),
+                '--seed', str(args.seed),
+                '--out-dir', csv_dir,
+            ],
+            check=True,
+        )
+        loader.seed(csv_dir, batch_size=10000)
+
+
+def pick_subjects():
+    """Pick the busiest rows, where slow code paths hurt most.
+
+    Returns (viewer id, most followed user id, most liked message id). The
+    viewer follows the most people, so has the biggest home feed. The
+    message is one the viewer may like, i.e. not their own.
+    """
+
+    viewer_id, = (db.session.query(Follows.user_following_id)
+                  .group_by(Follows.user_following_id)
+                  .order_by(db.func.count().desc())
+                  .first())
+    popular_id, = (db.session.query(User.id)
+                   .order_by(User.followers_count.desc())
+                   .first())
+    message_id, = (db.session.query(Message.id)
+                   .filter(Message.user_id != viewer_id)
+                   .order_by(Message.like_count.desc())
+                   .first())
+
+    return viewer_id, popular_id, message_id
+
+
+def hot_routes(viewer_id, popular_id, message_id):
+    """Return {name: Route}.
+
+    Liking and unliking are timed separately, each starting from the
+    opposite state, so every sample takes the same path.
+    """
+
+    viewer = User.query.get(viewer_id)
+
+    def set_liked(liked):
+        def reset():
+            Like.set_liked(viewer_id, message_id, liked)
+            db.session.commit()
+            db.session.remove()
+
+        return reset
+
+    like_url = f'/messages/{message_id}/like'
+
+    return {
+        'home': Route('GET', '/'),
+        'users': Route('GET', '/users'),
+        'user profile': Route('GET', f'/users/{popular_id}'),
+        'followers': Route('GET', f'/users/{popular_id}/followers'),
+        'like': Route(
+            'POST', like_url, json={'liked': True}, reset=set_liked(False)),
+        'unlike': Route(
+            'POST', like_url, json={'liked': False}, reset=set_liked(True)),
+        'login': Route(
+            'POST', '/login',
+            data={'username': viewer.username, 'password': PASSWORD},
+            logged_in=False),
+    }
+
+
+def clear_caches():
+    """Start every request cold, like a request that misses every cache."""
+
+    user_cache.local.clear()
+    liked_ids_cache.local.clear()
+    rate_limit_store.clear()
+    message_cards.cache.clear()
+
+
+def run_once(client, route):
+    response = client.open(
+        route.url, method=route.method, data=route.data, json=route.json)
+    if response.status_code >= 400:
+        raise RuntimeError(
+            f"{route.method} {route.url} returned {response.status_code}")
+
+    # A real request starts with an empty session; don't let the identity
+    # map carry rows over from the last one.
+    db.session.remove()
+
+
+def measure(client, route, iterations, warmup):
+    """Return latency percentiles (ms), statements and KiB allocated per
+    request for one route.
+    """
+
+    def prepare():
+        if route.reset is not None:
+            route.reset()
+        clear_caches()
+
+    for _ in range(warmup):
+        prepare()
+        run_once(client, route)
+
+    latencies = []
+    queries = []
+    for _ in range(iterations):
+        prepare()
+        with QueryRecorder(db.engine) as recorder:
+            start = perf_counter()
+            run_once(client, route)
+            latencies.append((perf_counter() - start) * 1000)
+        queries.append(recorder.count)
+
+    # tracemalloc slows everything down, so allocations get their own pass.
+    allocations = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(iterations, 10)):
+            prepare()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            run_once(client, route)
+            _, peak = tracemalloc.get_traced_memory()
+            allocations.append((peak - before) / 1024)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return {
+        'p50_ms': round(percentile(0.50), 2),
+        'p95_ms': round(percentile(0.95), 2),
+        'p99_ms': round(percentile(0.99), 2),
+        'mean_ms': round(mean(latencies), 2),
+        'queries': median(queries),
+        'peak_kib': round(median(allocations), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of `results` against `baseline`."""
+
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+
+        if result['queries'] > before['queries']:
+            regressions.append(
+                f"{name}: queries {before['queries']} -> {result['queries']}")
+
+        if result['peak_kib'] > before['peak_kib'] * (1 + tolerance):
+            regressions.append(
+                f"{name}: peak memory {before['peak_kib']}KiB -> "
+                f"{result['peak_kib']}KiB")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot routes against a seeded database.")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--follows", type=int, default=100000)
+    parser.add_argument("--likes", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-seed", action="store_true",
+        help="reuse the data already in the database")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument(
+        "--save", metavar="PATH", help="write the results to PATH as JSON")
+    parser.add_argument(
+        "--baseline", metavar="PATH",
+        help="compare with results saved earlier by --save")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="allowed slowdown or memory growth over the baseline "
+             "(default: 0.2, i.e. 20%%)")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed(args)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    viewer_id, popular_id, message_id = pick_subjects()
+    routes = hot_routes(viewer_id, popular_id, message_id)
+    db.session.remove()
+
+    results = {}
+    for name, route in routes.items():
+        client = app.test_client()
+        if route.logged_in:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = viewer_id
+
+        results[name] = measure(client, route, args.iterations, args.warmup)
+
+    columns = ['p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'queries', 'peak_kib']
+    print(f"\n{'route':<14}" + "".join(f"{c:>10}" for c in columns))
+    for name, result in results.items():
+        print(f"{name:<14}" + "".join(f"{result[c]:>10}" for c in columns))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        if regressions:
+            print("\nRegressions against the baseline:")
+            print("\n".join(f"  {regression}" for regression in regressions))
+            sys.exit(1)
+
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,243 @@
+"""Caches for Warbler: process-local LRU caches and shared backends."""
+
+import sys
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+try:
+    import redis
+except ImportError:  # only needed for a redis:// shared cache
+    redis = None
+
+
+class LRUCache:
+    """Thread-safe, size-bounded cache whose entries expire after `ttl`
+    seconds.
+
+    Each process has its own cache, so invalidating an entry only affects the
+    current process; the TTL bounds how stale other processes can get.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if it is missing
+        or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used entry
+        if the cache is full.
+        """
+
+        with self._lock:
+            self._entries[key] = (value, monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key` from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class SizedLRUCache:
+    """Thread-safe cache bounded by the total size of its values rather than
+    their number; the least recently used entries go first.
+
+    `sizeof(value)` gives the size of each value, in bytes by default.
+    Entries never expire, so keys should change whenever their value would.
+    """
+
+    def __init__(self, max_bytes, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if it is missing."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting least recently used entries
+        until everything fits. A value bigger than the whole cache isn't
+        kept.
+        """
+
+        size = self.sizeof(value)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class MemoryBackend:
+    """In-memory stand-in for a shared cache backend such as Redis.
+
+    Values are strings. Useful for development and tests; it is not shared
+    between processes.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self._values[key]
+                return None
+
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, monotonic() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class RedisBackend:
+    """Shared cache backend stored in Redis (needs the `redis` package)."""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The redis package is needed for a redis:// cache")
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key):
+        return self._redis.get(key)
+
+    def set(self, key, value, ttl):
+        self._redis.set(key, value, ex=ttl)
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+
+def backend_from_url(url):
+    """Return the shared cache backend for `url`, or None if it is empty.
+
+    `memory://` gives the in-process stand-in; `redis://...` gives Redis.
+    """
+
+    if not url:
+        return None
+
+    if url.startswith('memory://'):
+        return MemoryBackend()
+
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+
+class TieredCache:
+    """A process-local LRUCache, or a shared backend when there is one.
+
+    A delete can only reach the local cache of the process that makes it,
+    so with a shared backend the local cache is skipped: every process then
+    sees deletes at once instead of serving stale entries until they
+    expire. The shared backend holds strings made by `dumps` and read back
+    by `loads`; entries expire after the local cache's `ttl`.
+    """
+
+    def __init__(self, local, shared=None, prefix='', dumps=None, loads=None):
+        self.local = local
+        self.shared = shared
+        self.prefix = prefix
+        self.dumps = dumps
+        self.loads = loads
+
+    def get(self, key):
+        """Return the cached value for `key`, or None."""
+
+        if self.shared is None:
+            return self.local.get(key)
+
+        data = self.shared.get(f"{self.prefix}{key}")
+        return None if data is None else self.loads(data)
+
+    def set(self, key, value):
+        """Cache `value` under `key`."""
+
+        if self.shared is None:
+            self.local.set(key, value)
+        else:
+            self.shared.set(
+                f"{self.prefix}{key}", self.dumps(value), self.local.ttl)
+
+    def delete(self, *keys):
+        """Remove `keys` from the cache."""
+
+        for key in keys:
+            if self.shared is None:
+                self.local.delete(key)
+            else:
+                self.shared.delete(f"{self.prefix}{key}")
@@ -0,0 +1,127 @@
+"""Cached HTML for message cards.
+
+A message card (templates/messages/card.html) looks the same to every
+viewer apart from its like button and like count. MessageCards renders the
+rest of each card once and keeps it in a SizedLRUCache, keyed by message id
+and the author's profile_version: a message's text never changes, and
+editing a profile bumps the version. Rendering a list of cards is then
+mostly joining cached strings around one of three pre-rendered like
+buttons, picked from the viewer's id and liked message ids, and the
+message's like_count.
+"""
+
+import sys
+
+from flask import current_app, g
+from markupsafe import Markup
+
+from caching import SizedLRUCache
+
+# Put where the like button and count go while a card is rendered, then
+# split on.
+LIKE_BUTTON_SLOT = '<!-- like-button -->'
+LIKE_COUNT_SLOT = '<!-- like-count -->'
+
+
+def _card_size(card):
+    # Plus roughly the key and the cache's bookkeeping for the entry
+    return sum(sys.getsizeof(part) for part in card) + 200
+
+
+def like_count(message):
+    """Return `message`'s like count, including likes still waiting in the
+    write-behind buffer (see like_buffer.py), if it is on.
+    """
+
+    like_buffer = current_app.extensions.get('like_buffer')
+    if like_buffer is None or not like_buffer.enabled:
+        return message.like_count
+
+    return message.like_count + like_buffer.like_count_delta(message.id)
+
+
+class MessageCards:
+    """Renders message cards from a cache, as a Flask extension.
+
+    Templates call `message_cards(messages, liked_ids)`. Messages need
+    their author loaded (see `with_authors`).
+
+    Config:
+
+    - MESSAGE_CARD_CACHE_BYTES: memory the cached cards may use; 0 turns
+      the cache off.
+
+    The cache is bypassed while templates auto-reload (e.g. in debug mode),
+    so edits to the templates show up straight away.
+    """
+
+    def __init__(self, app=None):
+        self.cache = None
+        self._buttons = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = SizedLRUCache(
+            app.config.get('MESSAGE_CARD_CACHE_BYTES', 32 * 1024 * 1024),
+            sizeof=_card_size)
+        app.add_template_global(self.render, 'message_cards')
+
+    def render(self, messages, liked_ids=()):
+        """Return the cards for `messages`, as seen by `g.user`."""
+
+        use_cache = (
+            self.cache.max_bytes and not current_app.jinja_env.auto_reload)
+
+        own, liked, not_liked = self._like_buttons(use_cache)
+        viewer_id = g.user.id if g.user else None
+
+        parts = []
+        for message in messages:
+            head, middle, tail = self._card(message, use_cache)
+
+            if message.user_id == viewer_id:
+                button = own
+            elif message.id in liked_ids:
+                button = liked
+            else:
+                button = not_liked
+
+            parts += (head, button, middle, str(like_count(message)), tail)
+
+        return Markup(''.join(parts))
+
+    def _card(self, message, use_cache):
+        key = (message.id, message.user.profile_version)
+
+        card = self.cache.get(key) if use_cache else None
+        if card is None:
+            html = current_app.jinja_env.get_template(
+                'messages/card.html').render(
+                    message=message,
+                    like_button=Markup(LIKE_BUTTON_SLOT),
+                    like_count=Markup(LIKE_COUNT_SLOT))
+            head, rest = html.split(LIKE_BUTTON_SLOT, 1)
+            card = (head, *rest.split(LIKE_COUNT_SLOT, 1))
+
+            if use_cache:
+                self.cache.set(key, card)
+
+        return card
+
+    def _like_buttons(self, use_cache):
+        """Return the like button for your own message, a liked one and one
+        you haven't liked.
+        """
+
+        if self._buttons is None or not use_cache:
+            template = current_app.jinja_env.get_template(
+                'users/like-form.html')
+            self._buttons = (
+                template.render(own=True, liked=False),
+                template.render(own=False, liked=True),
+                template.render(own=False, liked=False),
+            )
+
+        return self._buttons
@@ -2,76 +2,258 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 50000000 --seed 1
+
+Rows are written as they are made, so memory use doesn't grow with the row
+counts, and the same --seed and --until always give the same files. Nothing
+is fetched over the network.
+
+Follower counts and posting activity follow power laws (a few users have
+most of the followers and write most of the messages), and posts come in
+bursts rather than evenly spread over time.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+from datetime import date, datetime, time
+from random import Random
+from time import perf_counter
+
+from helpers import (
+    CITIES,
+    FIRST_NAMES,
+    HEADER_IMAGE_URLS,
+    IMAGE_URLS,
+    LAST_NAMES,
+    bursty_timestamps,
+    get_random_sentence,
+    get_random_text,
+    hashed_fraction,
+    pareto_count,
+    shuffled_ids,
+    zipf_rank,
+    zipf_rank_at,
+)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# How lopsided popularity is: higher means more of the follows, posts and
+# likes go to the top few users and messages.
+FOLLOW_EXPONENT = 1.1
+POSTING_EXPONENT = 0.8
+LIKE_EXPONENT = 1.0
+
+# Newest message date unless --until says otherwise; fixed, so that runs on
+# different days give the same files.
+DEFAULT_UNTIL = date(2026, 10, 15)
+
+
+def generate_users(rng, num_users):
+    """Yield user rows. Usernames and emails are unique by construction."""
+
+    for i in range(1, num_users + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+
+        yield (
+            f"{first}.{last}{i}@example.com",
+            f"{first}{last}{i}",
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            get_random_sentence(rng),
+            rng.choice(HEADER_IMAGE_URLS),
+            rng.choice(CITIES),
+        )
+
+
+def message_authors(rng, num_users):
+    """Return a function giving the author of each message id, mostly one
+    of a small set of prolific users.
+
+    Authors come from a hash of the message id rather than from `rng` in
+    turn, so any message's author can be looked up again later (to keep
+    users from liking their own messages) without holding a list of them.
+    """
+
+    author_for_rank = shuffled_ids(num_users, rng)
+    key = rng.getrandbits(64)
+
+    def author_of(message_id):
+        u = hashed_fraction(key, message_id)
+        return author_for_rank(zipf_rank_at(u, num_users, POSTING_EXPONENT))
+
+    return author_of
+
+
+def generate_messages(rng, num_messages, until, author_of):
+    """Yield message rows, written by `author_of(message_id)`."""
+
+    timestamps = bursty_timestamps(rng, num_messages, until)
+    for message_id, timestamp in enumerate(timestamps, start=1):
+        yield (
+            get_random_text(rng, MAX_WARBLER_LENGTH),
+            timestamp,
+            author_of(message_id),
+        )
+
+
+def pick_distinct(rng, count, num_items, id_for_rank, exponent, skip=None):
+    """Pick up to `count` distinct ids, favouring popular (low-rank) ones,
+    and leaving out any for which `skip(id)` is true.
+
+    Gives up after a few misses per pick, so very popular ids can't make it
+    loop for long; a pick may then come up slightly short.
+    """
+
+    picked = set()
+    attempts = count * 4
+
+    while len(picked) < count and attempts:
+        attempts -= 1
+        item_id = id_for_rank(zipf_rank(rng, num_items, exponent))
+        if skip is None or not skip(item_id):
+            picked.add(item_id)
+
+    return picked
+
+
+def generate_follows(rng, num_follows, num_users):
+    """Yield about `num_follows` follow rows.
+
+    How many people each user follows is heavy-tailed, and who they follow
+    is drawn from a power law, so a few accounts collect most followers.
+    Only one user's picks are held in memory at a time.
+    """
+
+    followed_for_rank = shuffled_ids(num_users, rng)
+    remaining = num_follows
+
+    for follower in range(1, num_users + 1):
+        if remaining <= 0:
+            break
+
+        # Spreading what's left over the remaining users makes up for picks
+        # that came up short.
+        mean = remaining / (num_users - follower + 1)
+        count = min(pareto_count(rng, mean, num_users - 1), remaining)
+        followed = pick_distinct(
+            rng, count, num_users, followed_for_rank, FOLLOW_EXPONENT,
+            skip=lambda user_id: user_id == follower)
+        remaining -= len(followed)
+
+        for followed_id in sorted(followed):
+            yield followed_id, follower
+
+
+def generate_likes(rng, num_likes, num_users, num_messages, author_of):
+    """Yield about `num_likes` like rows; a few messages get most likes.
+
+    Nobody likes their own messages, going by `author_of(message_id)`.
+    """
+
+    message_for_rank = shuffled_ids(num_messages, rng)
+    remaining = num_likes
+
+    for user_id in range(1, num_users + 1):
+        if remaining <= 0:
+            break
+
+        mean = remaining / (num_users - user_id + 1)
+        count = min(pareto_count(rng, mean, num_messages), remaining)
+        liked = pick_distinct(
+            rng, count, num_messages, message_for_rank, LIKE_EXPONENT,
+            skip=lambda message_id: author_of(message_id) == user_id)
+        remaining -= len(liked)
+
+        for message_id in sorted(liked):
+            yield user_id, message_id
+
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+def write_csv(path, headers, rows):
+    """Stream `rows` into a CSV file at `path` and report how it went."""
 
-fake = Faker()
+    start = perf_counter()
+    count = 0
 
-# Generate random profile image URLs to use for users
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+        for row in rows:
+            writer.writerow(row)
+            count += 1
 
-# Generate random header image URLs to use for users
+    elapsed = perf_counter() - start
+    print(f"Wrote {count:,} rows to {path} in {elapsed:.1f}s")
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument(
+        "--follows", type=int, default=5000,
+        help="target number of follows (may come out slightly lower)")
+    parser.add_argument(
+        "--likes", type=int, default=2000,
+        help="target number of likes (may come out slightly lower)")
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="random seed, for repeatable output")
+    parser.add_argument(
+        "--until", type=date.fromisoformat, default=DEFAULT_UNTIL,
+        help="date of the newest messages, YYYY-MM-DD "
+             f"(default: {DEFAULT_UNTIL})")
+    parser.add_argument(
+        "--out-dir", default=os.path.dirname(os.path.abspath(__file__)),
+        help="where to write the CSVs (default: next to this script)")
+    args = parser.parse_args()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+    if args.likes and not args.messages:
+        parser.error("--likes needs --messages")
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    os.makedirs(args.out_dir, exist_ok=True)
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    def path(name):
+        return os.path.join(args.out_dir, name)
 
-# Generate follows.csv from random pairings of users
+    # One random generator per file, each seeded from the main seed, so
+    # e.g. asking for more likes doesn't change the users or messages.
+    seeds = Random(args.seed)
+    users_rng, messages_rng, follows_rng, likes_rng, authors_rng = (
+        Random(seeds.getrandbits(64)) for _ in range(5))
+    author_of = message_authors(authors_rng, args.users)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    write_csv(
+        path('users.csv'), USERS_CSV_HEADERS,
+        generate_users(users_rng, args.users))
+    write_csv(
+        path('messages.csv'), MESSAGES_CSV_HEADERS,
+        generate_messages(
+            messages_rng, args.messages,
+            datetime.combine(args.until, time()), author_of))
+    write_csv(
+        path('follows.csv'), FOLLOWS_CSV_HEADERS,
+        generate_follows(follows_rng, args.follows, args.users))
+    write_csv(
+        path('likes.csv'), LIKES_CSV_HEADERS,
+        generate_likes(
+            likes_rng, args.likes, args.users, args.messages, author_of))
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == "__main__":
+    main()
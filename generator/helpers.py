@@ -1,14 +1,203 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
+from math import gcd
 
+WORDS = """
+    able about above across act add age ago agree air all almost alone along
+    already also always amount and animal answer any area arm art ask away
+    baby back bad bag ball bank bar base beat bed best better big bill bit
+    black blue board body book born both box boy break bring brother build
+    call camera car card care carry case cat catch cause center chair chance
+    change charge child choice city class clear close coach cold color come
+    common cost could country couple course cover cup cut dark data day deal
+    deep degree design detail die dinner do dog door down draw dream drive
+    drop during each early east easy eat edge effect eight either else end
+    enjoy enough entire even evening event ever every eye face fact fall
+    family far fast father fear feel few field fight fill film final find
+    fine fire firm fish five floor fly focus follow food foot force forget
+    form free friend front full fund game garden gas give glass goal good
+    green ground group grow guess gun hair half hand hang happy hard head
+    hear heart heat heavy help here high hit hold home hope hot hour house
+    huge idea image inside issue item job join just keep key kid kind kitchen
+    know land large last late laugh law lead learn leave left leg less letter
+    level life light like line list listen little live long look lose lot
+    love low machine main make man many map mark market matter may meal
+    mean media meet member memory method middle might mind minute miss model
+    moment money month more morning most mother mouth move movie much music
+    name nation near need never new news next nice night none north note
+    nothing now number off office often oil old once only open order other
+    own page pain paper part party pass past pay peace people per pick
+    picture piece place plan plant play point police poor power pretty price
+    pull push put quick quite race radio rain raise range rate reach read
+    ready real reason red rest rich ride right rise risk river road rock
+    role room rule run safe same save say scene school sea season seat see
+    sell send serve set seven share short show side sign simple sing sister
+    sit six size skin sleep small smile snow social soft some son song soon
+    sort sound south space speak spend sport spring staff stage stand star
+    start state stay step still stock stop store story street strong student
+    study style sure table take talk tax teach team tell ten term test thank
+    theory thing think three throw time today tonight top total tough town
+    trade travel tree trip true try turn two type under unit until upon use
+    usually value very view visit voice wait walk wall want war watch water
+    way wear week weight well west white whole wide wife win wind window
+    wish woman wonder word work world write wrong yard year yes yet young
+""".split()
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+FIRST_NAMES = """
+    alex amy andre ana ben bella carl chloe dan diana eli emma felix fiona
+    gabe grace hank hana ian iris jack jade kai kara leo lily max maya nate
+    nina omar olive paul priya quinn rosa ryan sara sam tara theo una victor
+    vera will wendy xavi yara zack zoe
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+LAST_NAMES = """
+    adams baker brown chen clark davis diaz evans garcia green hall harris
+    hill jones kim king lee lewis lopez martin miller moore nguyen patel
+    perez reed rivera roberts scott smith taylor thomas turner walker white
+    wilson wright young
+""".split()
 
-    return datetime.fromtimestamp(random_timestamp)
+CITIES = """
+    Austin Berlin Boston Cairo Chicago Denver Dublin Hanoi Houston Lagos
+    Lima London Madrid Manila Miami Montreal Mumbai Nairobi Oakland Oslo
+    Paris Portland Quito Seattle Seoul Sydney Tokyo Toronto Vancouver Vienna
+""".split()
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URLS = [
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{name}_1280.jpg"
+    for name in """
+        mo2x3aAnRH1st5lhmo1 mo2xijE2nr1st5lhmo1 mnh17lfd9R1st5lhmo1
+        mp6rzyNlAN1st5lhmo1 mo1h6tGOZf1st5lhmo1 mnh1d7s3UD1st5lhmo1
+        mnh2m1hnS81st5lhmo1 mpp6f50W261st5lhmo1 mp6s32zb6l1st5lhmo1
+        mp6scv2xrZ1st5lhmo1 mo2xgqdEFn1st5lhmo1 mnh0uemhCk1st5lhmo1
+        mnh25vNOvI1st5lhmo1 mnh29fxz111st5lhmo1 mnh1uhYnog1st5lhmo1
+        mnh1jdFvHR1st5lhmo1 mopq4kHmAg1st5lhmo1 mopqamedKu1st5lhmo1
+        mpp6tjdFhf1st5lhmo1 mo2xdqmle51st5lhmo1 mp6s7lR1lS1st5lhmo1
+        mopq69jlcS1st5lhmo1 mopq8fyQwI1st5lhmo1 mp6sasSvPZ1st5lhmo1
+        mpp6poZxE51st5lhmo1 mpp6w0dxAm1st5lhmo1 mopqdfx05t1st5lhmo1
+        mopqj9QUeq1st5lhmo1 mnh0n9pHJW1st5lhmo1 mpp6l06zXi1st5lhmo1
+        mopqc3ZZcz1st5lhmo1 mo2wz2LTCs1st5lhmo1 mp6s1hAudo1st5lhmo1
+        mopqhxFulr1st5lhmo1 mnh121HEWa1st5lhmo1 mpp6gwrYvm1st5lhmo1
+        mopqfpSTPN1st5lhmo1 mp6s995bvI1st5lhmo1 mp6s4dzqHA1st5lhmo1
+        mo2x9xqeef1st5lhmo1 mopqkkwK2M1st5lhmo1 mo2xbk8JUK1st5lhmo1
+        mp6s661UgK1st5lhmo1 mo2x80NkDu1st5lhmo1 mo2xfarCvW1st5lhmo1
+    """.split()
+]
+
+
+def get_random_datetime(rng, now, year_gap=2):
+    """Get a random datetime within the few years before `now`."""
+
+    span = timedelta(days=365 * year_gap)
+    return now - span * rng.random()
+
+
+def get_random_sentence(rng, min_words=4, max_words=12):
+    """Get a sentence of random words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def get_random_text(rng, max_length):
+    """Get a few random sentences, cut to `max_length` characters."""
+
+    sentences = [get_random_sentence(rng) for _ in range(rng.randint(1, 3))]
+    return " ".join(sentences)[:max_length]
+
+
+def shuffled_ids(n, rng):
+    """Return a function mapping ranks 0..n-1 onto ids 1..n in a scrambled
+    order.
+
+    This is an affine permutation, `(a * rank + b) % n`, so it needs no
+    memory; it just keeps the most popular ranks from all being the lowest
+    ids.
+    """
+
+    a = rng.randrange(1, n) if n > 1 else 1
+    while gcd(a, n) != 1:
+        a += 1
+    b = rng.randrange(n)
+
+    return lambda rank: (a * rank + b) % n + 1
+
+
+def hashed_fraction(key, i):
+    """Return a number in [0, 1) that depends only on `key` and `i`.
+
+    Like rng.random(), but the i-th number can be had without drawing the
+    ones before it. This is the splitmix64 mixing function.
+    """
+
+    x = (key + (i + 1) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    x ^= x >> 31
+
+    return (x >> 11) / (1 << 53)
+
+
+def zipf_rank(rng, n, exponent=1.0):
+    """Pick a rank in 0..n-1 where rank k is chosen in proportion to roughly
+    1 / (k + 1) ** exponent.
+    """
+
+    return zipf_rank_at(rng.random(), n, exponent)
+
+
+def zipf_rank_at(u, n, exponent=1.0):
+    """zipf_rank for a given uniform number `u` in [0, 1).
+
+    Uses the inverse CDF of the continuous power law, which is O(1) per
+    pick, unlike building a table of n weights.
+    """
+
+    if exponent == 1.0:
+        x = (n + 1) ** u
+    else:
+        power = 1.0 - exponent
+        x = (((n + 1) ** power - 1.0) * u + 1.0) ** (1.0 / power)
+
+    return min(int(x) - 1, n - 1)
+
+
+def pareto_count(rng, mean, maximum, alpha=1.5):
+    """Pick a heavy-tailed count with the given mean, capped at `maximum`.
+
+    Most picks are well below the mean and a few are far above it, like the
+    number of accounts a person follows.
+    """
+
+    if mean <= 0:
+        return 0
+
+    scale = mean * (alpha - 1) / alpha
+    return min(int(scale * rng.paretovariate(alpha)), maximum)
+
+
+def bursty_timestamps(rng, count, now, year_gap=2, burst_chance=0.1,
+                      mean_gap=timedelta(minutes=5)):
+    """Yield `count` posting times from the few years before `now` that
+    cluster in bursts: each burst starts at a random time and its posts
+    follow each other a few minutes apart.
+    """
+
+    timestamp = get_random_datetime(rng, now, year_gap)
+    for _ in range(count):
+        if rng.random() < burst_chance:
+            timestamp = get_random_datetime(rng, now, year_gap)
+        else:
+            gap = rng.expovariate(1.0 / mean_gap.total_seconds())
+            timestamp += timedelta(seconds=gap)
+            if timestamp > now:
+                timestamp = get_random_datetime(rng, now, year_gap)
+
+        yield timestamp
@@ -0,0 +1,168 @@
+"""HTTP caching policy for Warbler.
+
+- Static files linked with `static_url` carry a fingerprint of their
+  contents (?v=...), so browsers may keep them for a year without asking
+  again; a changed file gets a new URL. Other static requests are
+  revalidated against the ETag Flask already sends.
+- Views wrapped in `conditional` get an ETag built from the version
+  counters of everything they show. A request whose If-None-Match still
+  matches gets a 304 before the view runs, so nothing else is queried and
+  no template is rendered.
+- Every other response stays `no-store`, since pages show per-user state
+  that has no version to check.
+"""
+
+import hashlib
+import os
+from functools import wraps
+from time import time
+
+from flask import current_app, request, session, url_for
+
+# Seconds fingerprinted static files may be cached for (a year).
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Static file path -> (mtime, fingerprint)
+_fingerprints = {}
+
+
+def _digest(*chunks):
+    digest = hashlib.blake2b(digest_size=8)
+    for chunk in chunks:
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fingerprint(filename):
+    """Return a short hash of static file `filename`'s contents, or None if
+    there is no such file. Rehashed only when the file's mtime changes.
+    """
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = _fingerprints[path] = (mtime, _digest(f.read()))
+
+    return cached[1]
+
+
+def static_url(filename):
+    """Return the URL of static file `filename`: its built copy if there is
+    one (see assets.py), otherwise fingerprinted if it exists.
+    """
+
+    assets = current_app.extensions.get('assets')
+    if assets is not None:
+        url = assets.url(filename)
+        if url != filename:
+            return url
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def _templates_version(app):
+    """Hash every template, so a deploy that changes them changes ETags."""
+
+    chunks = []
+    for root, _, files in sorted(os.walk(
+            os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                chunks += [name.encode(), f.read()]
+
+    return _digest(*chunks)
+
+
+def _make_etag(parts):
+    # The page also embeds a CSRF token, which expires after
+    # WTF_CSRF_TIME_LIMIT: change the ETag every half of that, so a page
+    # kept by a 304 always has a token with time left to use.
+    csrf_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_epoch = int(time() // (csrf_limit / 2)) if csrf_limit else 0
+
+    return _digest(repr((
+        current_app.extensions['http_caching'],
+        request.full_path,
+        session.get('csrf_token'),
+        csrf_epoch,
+        parts,
+    )).encode())
+
+
+def conditional(etag_parts):
+    """Make a GET view answer conditional requests.
+
+    `etag_parts(**view_args)` returns a tuple of the versions the page
+    depends on, cheaply (typically one query), or None to skip caching the
+    page. Pages are skipped while flashed messages are waiting, since
+    rendering them shows and removes the messages.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(**view_args):
+            parts = None
+            if not session.get('_flashes'):
+                parts = etag_parts(**view_args)
+
+            if parts is None:
+                return view(**view_args)
+
+            etag = _make_etag(parts)
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            # Kept by the browser only, and checked with us before each use
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+
+        return conditional_view
+
+    return decorator
+
+
+def set_cache_headers(response):
+    """Apply the caching policy to `response` (an after_request hook)."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+
+        if version and version == fingerprint(request.view_args['filename']):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+
+    elif not response.cache_control:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
+
+    return response
+
+
+def apply_caching_policy(app):
+    """Apply the caching policy to `app` and add `static_url` to its
+    templates.
+    """
+
+    app.extensions['http_caching'] = _templates_version(app)
+    app.after_request(set_cache_headers)
+    app.add_template_global(static_url)
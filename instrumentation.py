@@ -0,0 +1,131 @@
+"""Per-endpoint request metrics for Warbler.
+
+Hooks Flask's request and template signals and SQLAlchemy's cursor events
+to record, for each endpoint, how many SQL statements a request ran, how
+long they took, how long templates took to render and how long the whole
+request took. The numbers go into histograms in `metrics`, which the
+/metrics view serves.
+
+Each hook only reads the clock and adds to a few numbers, so it is cheap
+enough to leave on in production.
+"""
+
+from time import perf_counter
+
+from flask import (
+    before_render_template, g, has_request_context, request,
+    request_finished, request_started, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Histogram
+
+# Upper bounds of the SQL statements per request buckets.
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+request_seconds = Histogram(
+    'warbler_request_seconds',
+    "Time to handle a request, from start to response.",
+    labelnames=('endpoint',))
+
+request_db_seconds = Histogram(
+    'warbler_request_db_seconds',
+    "Time a request spent running SQL statements.",
+    labelnames=('endpoint',))
+
+request_render_seconds = Histogram(
+    'warbler_request_render_seconds',
+    "Time a request spent rendering templates.",
+    labelnames=('endpoint',))
+
+request_queries = Histogram(
+    'warbler_request_queries',
+    "SQL statements run by a request.",
+    labelnames=('endpoint',),
+    buckets=QUERY_COUNT_BUCKETS)
+
+
+class RequestStats:
+    """Running totals for the request in progress (kept on `g`)."""
+
+    __slots__ = (
+        'start', 'queries', 'db_seconds', 'render_seconds',
+        'query_start', 'render_start')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.query_start = None
+        self.render_start = None
+
+
+def _stats():
+    if has_request_context():
+        return g.get('request_stats')
+
+    return None
+
+
+def _request_started(sender, **extra):
+    g.request_stats = RequestStats()
+
+
+def _request_finished(sender, response, **extra):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return
+
+    # Unmatched URLs share one label, so junk requests can't add series.
+    endpoint = request.endpoint or 'unmatched'
+
+    request_seconds.observe(perf_counter() - stats.start, endpoint=endpoint)
+    request_db_seconds.observe(stats.db_seconds, endpoint=endpoint)
+    request_render_seconds.observe(stats.render_seconds, endpoint=endpoint)
+    request_queries.observe(stats.queries, endpoint=endpoint)
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.render_start = perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.render_start is not None:
+        stats.render_seconds += perf_counter() - stats.render_start
+        stats.render_start = None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = _stats()
+    if stats is not None:
+        stats.query_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _stats()
+    if stats is not None and stats.query_start is not None:
+        stats.queries += 1
+        stats.db_seconds += perf_counter() - stats.query_start
+        stats.query_start = None
+
+
+def instrument(app):
+    """Record request metrics for `app`.
+
+    SQL is timed on every engine, so it doesn't matter which one the app
+    ends up with; statements run outside a request aren't counted.
+    """
+
+    request_started.connect(_request_started, app)
+    request_finished.connect(_request_finished, app)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
@@ -0,0 +1,430 @@
+"""Write-behind buffering of likes for Warbler.
+
+With LIKE_WRITE_BEHIND on, liking or unliking a message doesn't write to
+the database. LikeBuffer records the intent ("user 3 wants message 9
+liked") in memory, keeping only the latest one per (user, message), and
+appends it to a journal file. A background thread writes everything
+waiting to the likes table in one statement, every LIKE_FLUSH_INTERVAL
+seconds or as soon as LIKE_FLUSH_SIZE intents are waiting.
+
+Intents say what the end state should be rather than "toggle", so writing
+one twice does no harm: after a crash, the journal is simply replayed.
+Each intent carries the time it was asked for, and one older than the last
+written for the same like is skipped (see models.LikeStamp). So when a
+user's clicks land in different processes, the last click wins whichever
+process writes first; the servers' clocks need to agree (e.g. NTP).
+Each process keeps its own journal (named after its pid) in
+LIKE_JOURNAL_DIR; journals left by processes that are no longer running
+are taken over on start.
+
+Until their intents are written, a user's own reads (`pending_for`) and
+like counts (`like_count_delta`) are adjusted to include them. When
+LIKE_BUFFER_SIZE intents are already waiting, new ones are written
+straight away instead.
+"""
+
+import atexit
+import json
+import os
+from collections import Counter, defaultdict
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+from models import db, Like, Message, ToggledLike
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class LikeBuffer:
+    """In-process write-behind buffer for likes, as a Flask extension.
+
+    Config:
+
+    - LIKE_WRITE_BEHIND: buffer likes (default off: each is written and
+      committed by its own request).
+    - LIKE_BUFFER_SIZE: most intents waiting at once.
+    - LIKE_FLUSH_INTERVAL: seconds between writes.
+    - LIKE_FLUSH_SIZE: write early once this many intents are waiting.
+    - LIKE_JOURNAL_DIR: folder for the journals.
+
+    `on_flushed(user_ids)` is called after each write with the users whose
+    intents were written, e.g. to drop cached copies of their likes.
+    """
+
+    def __init__(self, app=None, on_flushed=None):
+        self.app = None
+        self.enabled = False
+        self.max_size = 10000
+        self.flush_interval = 1.0
+        self.flush_size = 500
+        self.journal_dir = None
+        self.on_flushed = on_flushed
+
+        # (user_id, message_id) -> [liked, liked in the database before,
+        # when it was asked for]
+        self._pending = {}
+        # The same, for the intents being written right now
+        self._flushing = {}
+        # Both of the above, as user_id -> {message_id: liked}
+        self._by_user = defaultdict(dict)
+        # message_id -> likes the database doesn't have yet (or has too many)
+        self._count_deltas = Counter()
+        # Bumped after each write, so reads made before it can be retried
+        self._generation = 0
+
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wake = Event()
+        self._flusher_pid = None
+
+        # Journal lines recorded (under _lock) but not yet written, and how
+        # many lines have been queued and made durable in all. Writes and
+        # fsyncs happen under _journal_lock only, so they never hold up
+        # readers of the buffer. Take _journal_lock before _lock.
+        self._journal_lock = Lock()
+        self._journal_queue = []
+        self._queued = 0
+        self._synced = 0
+        self._journal = None
+        self._journal_pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('LIKE_WRITE_BEHIND', False)
+        self.max_size = app.config.get('LIKE_BUFFER_SIZE', 10000)
+        self.flush_interval = app.config.get('LIKE_FLUSH_INTERVAL', 1.0)
+        self.flush_size = app.config.get('LIKE_FLUSH_SIZE', 500)
+
+        app.extensions['like_buffer'] = self
+
+        if self.enabled:
+            self.journal_dir = app.config.get('LIKE_JOURNAL_DIR') or (
+                os.path.join(app.instance_path, 'like-journal'))
+            os.makedirs(self.journal_dir, exist_ok=True)
+
+            self._replay()
+            atexit.register(self._flush_at_exit)
+
+    # Journal
+
+    @property
+    def journal_path(self):
+        """This process's journal."""
+
+        return os.path.join(self.journal_dir, f'{os.getpid()}.jsonl')
+
+    def _replay(self):
+        """Load the intents in our own journal and in those of processes
+        that have stopped, then fold them into our journal.
+        """
+
+        taken = []
+        for name in sorted(os.listdir(self.journal_dir)):
+            stem, ext = os.path.splitext(name)
+            if ext != '.jsonl' or not stem.isdigit():
+                continue
+
+            path = os.path.join(self.journal_dir, name)
+            if path != self.journal_path and _pid_running(int(stem)):
+                continue
+
+            with open(path) as f:
+                for line in f:
+                    try:
+                        user_id, message_id, liked, base, recorded_at = (
+                            json.loads(line))
+                    except ValueError:
+                        continue  # cut short by a crash mid-write
+
+                    self._set((user_id, message_id), liked, base,
+                              datetime.fromisoformat(recorded_at))
+
+            taken.append(path)
+
+        self._rewrite_journal()
+
+        for path in taken:
+            if path != self.journal_path:
+                os.remove(path)
+
+    @staticmethod
+    def _journal_line(key, liked, base, recorded_at):
+        return json.dumps([*key, liked, base, recorded_at.isoformat()]) + '\n'
+
+    def _queue_journal_line(self, key):
+        """Queue the latest intent for `key` for the journal; return its
+        sequence number. Call with the lock held.
+        """
+
+        self._journal_queue.append(
+            self._journal_line(key, *self._pending[key]))
+        self._queued += 1
+        return self._queued
+
+    def _sync_journal(self, sequence):
+        """Return once journal line `sequence` is on disk, writing it and
+        any others queued with it behind one fsync.
+        """
+
+        with self._journal_lock:
+            if self._synced >= sequence:
+                return  # written by another thread's fsync
+
+            with self._lock:
+                lines, self._journal_queue = self._journal_queue, []
+                queued = self._queued
+
+            if self._journal_pid != os.getpid():
+                # First write, or the first since a fork
+                self._journal = open(self.journal_path, 'a')
+                self._journal_pid = os.getpid()
+
+            self._journal.writelines(lines)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._synced = queued
+
+    def _rewrite_journal(self, update=None):
+        """Replace the journal with the intents still waiting, after calling
+        `update` (if given) with the lock held.
+        """
+
+        with self._journal_lock:
+            with self._lock:
+                if update is not None:
+                    update()
+
+                # Everything queued is in _pending already
+                lines = [
+                    self._journal_line(key, *intent)
+                    for key, intent in self._pending.items()
+                ]
+                self._journal_queue = []
+                queued = self._queued
+
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._journal_pid == os.getpid():
+                self._journal.close()
+                self._journal_pid = None
+
+            os.replace(tmp_path, self.journal_path)
+            self._synced = queued
+
+    # Buffer
+
+    def _current(self, key):
+        return self._pending.get(key) or self._flushing.get(key)
+
+    def _set(self, key, liked, base, recorded_at):
+        """Make `liked` the latest intent for `key`, unless the one there
+        is newer. Call with the lock held (or before anything else can see
+        the buffer).
+        """
+
+        current = self._current(key)
+        if current is not None and current[2] > recorded_at:
+            return  # e.g. from a journal replayed after a newer one
+
+        if current is not None:
+            self._count_deltas[key[1]] += liked - current[0]
+            base = current[1]
+        else:
+            self._count_deltas[key[1]] += liked - base
+
+        self._pending[key] = [liked, base, recorded_at]
+        self._by_user[key[0]][key[1]] = liked
+
+    def pending_for(self, user_id):
+        """Return {message_id: liked} for `user_id`'s unwritten intents."""
+
+        with self._lock:
+            return dict(self._by_user.get(user_id, {}))
+
+    def apply_pending(self, user_id, liked_ids, message_ids=None):
+        """Return `liked_ids` (from the database) adjusted by `user_id`'s
+        unwritten intents, limited to `message_ids` if given.
+        """
+
+        pending = self.pending_for(user_id)
+        if not pending:
+            return liked_ids
+
+        if message_ids is not None:
+            message_ids = set(message_ids)
+            pending = {
+                message_id: liked for message_id, liked in pending.items()
+                if message_id in message_ids
+            }
+
+        return frozenset(
+            {message_id for message_id, liked in pending.items() if liked}
+            | (liked_ids - pending.keys()))
+
+    def like_count_delta(self, message_id):
+        """Return how far message `message_id`'s like count in the database
+        is behind the unwritten intents.
+        """
+
+        with self._lock:
+            return self._count_deltas.get(message_id, 0)
+
+    def set_liked(self, user_id, message_id, liked):
+        """Like.set_liked, buffered: record that `user_id` wants
+        `message_id` liked (or not). Returns a ToggledLike of the message's
+        author, whether the user likes it now and how many likes it has
+        (counting unwritten intents), or None if there is no such message.
+
+        There is deliberately no buffered toggle: another process may hold
+        a newer intent for the same like, so only the state the user asked
+        for can be recorded safely.
+
+        Writes straight away, like Like.set_liked, if the buffer is full.
+        """
+
+        key = (user_id, message_id)
+        recorded_at = datetime.utcnow()
+
+        while True:
+            with self._lock:
+                generation = self._generation
+
+            row = (db.session.query(Message.user_id, Message.like_count)
+                   .filter(Message.id == message_id)
+                   .first())
+            if row is None:
+                return None
+
+            author_id, like_count = row
+            if author_id == user_id:
+                return ToggledLike(author_id, False, like_count)
+
+            liked_in_db = bool(Like.liked_among(user_id, [message_id]))
+
+            with self._lock:
+                if generation != self._generation:
+                    continue  # a write landed since; read again
+
+                if (key not in self._pending
+                        and len(self._pending) >= self.max_size):
+                    return Like.set_liked(
+                        user_id, message_id, liked, recorded_at)
+
+                self._set(key, liked, liked_in_db, recorded_at)
+                sequence = self._queue_journal_line(key)
+                like_count += self._count_deltas.get(message_id, 0)
+                waiting = len(self._pending)
+                break
+
+        self._sync_journal(sequence)
+        self._start_flusher()
+        if waiting >= self.flush_size:
+            self._wake.set()
+
+        return ToggledLike(author_id, liked, like_count)
+
+    # Flushing
+
+    def flush(self):
+        """Write every waiting intent to the database and commit; return
+        how many were written. Needs an app context.
+
+        If writing fails, the intents stay waiting and the error is raised.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+
+                batch = self._flushing = self._pending
+                self._pending = {}
+
+            try:
+                changed = Like.apply_intents([
+                    (user_id, message_id, liked, recorded_at)
+                    for (user_id, message_id), (liked, _, recorded_at)
+                    in batch.items()
+                ])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    for key, intent in batch.items():
+                        self._pending.setdefault(key, intent)
+                    self._flushing = {}
+                raise
+
+            def forget_written():
+                self._flushing = {}
+                self._generation += 1
+
+                for key, (liked, base, _) in batch.items():
+                    user_id, message_id = key
+                    self._count_deltas[message_id] -= liked - base
+                    if not self._count_deltas[message_id]:
+                        del self._count_deltas[message_id]
+
+                    if key in self._pending:
+                        # Recorded meanwhile: the database now has `liked`
+                        self._pending[key][1] = liked
+                    else:
+                        del self._by_user[user_id][message_id]
+                        if not self._by_user[user_id]:
+                            del self._by_user[user_id]
+
+            self._rewrite_journal(forget_written)
+
+        if self.on_flushed is not None:
+            self.on_flushed({user_id for user_id, _ in batch} | changed)
+
+        return len(batch)
+
+    def _start_flusher(self):
+        """Start the flushing thread in this process, if it isn't running
+        (e.g. after a fork).
+        """
+
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+
+            self._flusher_pid = os.getpid()
+
+        Thread(target=self._run_flusher, name='like-flusher',
+               daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception("Writing buffered likes failed")
+
+    def _flush_at_exit(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            # Still in the journal; written on the next start
+            self.app.logger.exception("Writing buffered likes failed")
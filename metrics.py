@@ -0,0 +1,147 @@
+"""In-process metrics for Warbler, exposed in Prometheus text format."""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds (in seconds) of the default latency buckets.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every metric made, in order, for render_prometheus.
+REGISTRY = []
+
+
+class Counter:
+    """A count that only goes up, optionally split by labels."""
+
+    def __init__(self, name, description, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the count for `labels`."""
+
+        key = tuple(labels[name] for name in self.labelnames)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """Return {label values: count}."""
+
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    """Counts of observed values (e.g. latencies) in fixed buckets,
+    optionally split by labels.
+    """
+
+    def __init__(self, name, description, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        """Record one observation of `value` for `labels`."""
+
+        key = tuple(labels[name] for name in self.labelnames)
+        bucket = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of the `with` block takes, in seconds."""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Return {label values: (cumulative bucket counts, sum, count)}.
+
+        Bucket counts line up with `buckets`, plus a final +Inf bucket.
+        """
+
+        with self._lock:
+            series = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._series.items()
+            }
+
+        for counts, _, _ in series.values():
+            running = 0
+            for i, bucket_count in enumerate(counts):
+                running += bucket_count
+                counts[i] = running
+
+        return series
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return (str(value)
+                .replace('\\', '\\\\')
+                .replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render_prometheus(registry=REGISTRY):
+    """Return every metric in `registry` in Prometheus text format."""
+
+    lines = []
+
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+
+        if isinstance(metric, Counter):
+            lines.append(f"# TYPE {metric.name} counter")
+            for key, value in metric.values().items():
+                labels = _format_labels(metric.labelnames, key)
+                lines.append(f"{metric.name}{labels} {value}")
+
+        else:
+            lines.append(f"# TYPE {metric.name} histogram")
+            bounds = [*(repr(float(b)) for b in metric.buckets), '+Inf']
+            for key, (counts, total, count) in metric.snapshot().items():
+                for bound, bucket_count in zip(bounds, counts):
+                    labels = _format_labels(
+                        metric.labelnames, key, [('le', bound)])
+                    lines.append(f"{metric.name}_bucket{labels} {bucket_count}")
+
+                labels = _format_labels(metric.labelnames, key)
+                lines.append(f"{metric.name}_sum{labels} {total}")
+                lines.append(f"{metric.name}_count{labels} {count}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,9 @@
+-- Denormalized counters on users.
+--
+-- New columns start at zero; fill them in afterwards with `flask recount`.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
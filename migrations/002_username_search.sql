@@ -0,0 +1,12 @@
+-- Indexes for the user directory search and typeahead.
+--
+-- pg_trgm is a contrib extension; without it substring searches still work
+-- but scan the users table.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix
+    ON users (username text_pattern_ops);
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm
+    ON users USING gin (username gin_trgm_ops);
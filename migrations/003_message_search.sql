@@ -0,0 +1,11 @@
+-- Full-text search over message text.
+--
+-- Adding a stored generated column rewrites the messages table; run this in
+-- a maintenance window on large databases.
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', text)) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_search_vector
+    ON messages USING gin (search_vector);
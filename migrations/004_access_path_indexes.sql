@@ -0,0 +1,13 @@
+-- Secondary indexes for the feed, follows and likes access paths.
+--
+-- CONCURRENTLY keeps the tables writable while the indexes build; psql runs
+-- each statement in its own transaction, as CONCURRENTLY requires.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, timestamp DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_follows_user_following_id
+    ON follows (user_following_id, user_being_followed_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_message_id
+    ON likes (message_id, user_id);
@@ -0,0 +1,6 @@
+-- Profile version counter on users, bumped by profile edits.
+--
+-- Cached message cards are keyed by it, so existing rows can start at zero.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,7 @@
+-- Version counter on users, bumped with their counters.
+--
+-- ETags for profile and message pages are built from it; existing rows can
+-- start at zero.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
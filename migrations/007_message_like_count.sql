@@ -0,0 +1,16 @@
+-- Denormalized like count on messages.
+--
+-- Filled in here from the likes table in one pass; `flask recount` rebuilds
+-- it later if it ever drifts.
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE messages
+SET like_count = counts.like_count
+FROM (
+    SELECT message_id, count(*) AS like_count
+    FROM likes
+    GROUP BY message_id
+) AS counts
+WHERE messages.id = counts.message_id;
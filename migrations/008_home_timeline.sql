@@ -0,0 +1,21 @@
+-- Materialized home timelines: one row per (reader, message).
+--
+-- Starts empty; fill it in afterwards with `flask rebuild-timelines`.
+
+CREATE TABLE IF NOT EXISTS home_timeline (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_home_timeline_user_id_timestamp
+    ON home_timeline (user_id, timestamp, message_id);
+
+-- Authors waiting for `flask backfill-timelines` after they stopped being
+-- celebrities.
+
+CREATE TABLE IF NOT EXISTS timeline_backfills (
+    author_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE
+);
@@ -0,0 +1,11 @@
+-- When the newest like or unlike applied for each (user, message) was asked
+-- for, so buffered likes written late can't undo newer ones.
+--
+-- Starts empty: a pair with no stamp takes whatever intent comes first.
+
+CREATE TABLE IF NOT EXISTS like_stamps (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    recorded_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
@@ -0,0 +1,20 @@
+-- When each like was made, so a user's liked messages can be paged in the
+-- order they were liked straight off an index.
+--
+-- Existing likes get their message's time, the nearest thing on record.
+-- psql runs each statement in its own transaction, as CONCURRENTLY requires.
+
+ALTER TABLE likes
+    ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITHOUT TIME ZONE;
+
+UPDATE likes
+SET created_at = messages.timestamp
+FROM messages
+WHERE messages.id = likes.message_id AND likes.created_at IS NULL;
+
+ALTER TABLE likes
+    ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP,
+    ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id_created_at
+    ON likes (user_id, created_at, message_id);
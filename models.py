@@ -1,16 +1,31 @@
 """SQLAlchemy models for Warbler."""
 
+import json
+from collections import Counter, namedtuple
 from datetime import datetime
+from heapq import merge
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
 
-bcrypt = Bcrypt()
+from pagination import page_and_cursor, encode_rank_cursor
+from passwords import PasswordHasher
+
+hasher = PasswordHasher()
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# How many of a user's recent messages get copied into a new follower's
+# home timeline when they start following them.
+TIMELINE_BACKFILL_SIZE = 100
+
+# How many entries each home timeline keeps, so how far back home feeds go.
+# Older ones are cut off by `flask trim-timelines`.
+TIMELINE_SIZE = 800
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -29,8 +44,110 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # The primary key leads with the followed user ("who follows X");
+        # this serves the reverse, "who does X follow".
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id', 'user_being_followed_id',
+        ),
+    )
+
+    @classmethod
+    def add(cls, user_id, followed_id):
+        """Make `user_id` follow `followed_id`, in a single INSERT that does
+        nothing if they already do or `followed_id` doesn't exist.
+
+        Returns whether a follow was added. Unlike appending to
+        `User.following`, this doesn't load who else the user follows.
+        """
+
+        columns = ['user_being_followed_id', 'user_following_id']
+        followed = (
+            db.select(User.id, db.literal(user_id))
+            .where(User.id == followed_id)
+        )
+        dialect = db.engine.dialect.name
+
+        if dialect == 'postgresql':
+            statement = postgresql.insert(cls).from_select(
+                columns, followed).on_conflict_do_nothing()
+        elif dialect == 'sqlite':
+            statement = sqlite.insert(cls).from_select(
+                columns, followed).on_conflict_do_nothing()
+        else:
+            # No ON CONFLICT to lean on: leave out a follow that's already
+            # there. A concurrent request adding the same follow can still
+            # get in first, making this raise IntegrityError.
+            statement = db.insert(cls).from_select(
+                columns,
+                followed.where(~db.exists().where(
+                    cls.user_being_followed_id == followed_id,
+                    cls.user_following_id == user_id,
+                )),
+            )
+
+        return db.session.execute(statement).rowcount > 0
+
+    @classmethod
+    def remove(cls, user_id, followed_id):
+        """Make `user_id` stop following `followed_id`, in a single DELETE.
+
+        Returns whether there was a follow to remove.
+        """
+
+        return (cls.query
+                .filter_by(
+                    user_being_followed_id=followed_id,
+                    user_following_id=user_id)
+                .delete(synchronize_session=False)) > 0
+
+
+class FollowChecks:
+    """Follow checks shared by User and CachedUser.
+
+    Each check is an indexed lookup on follows, not a scan of the user's
+    followers or following collection.
+    """
+
+    __slots__ = ()
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return db.session.query(
+            Follows.query.filter_by(
+                user_being_followed_id=self.id,
+                user_following_id=other_user.id,
+            ).exists()
+        ).scalar()
 
-class User(db.Model):
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return db.session.query(
+            Follows.query.filter_by(
+                user_being_followed_id=other_user.id,
+                user_following_id=self.id,
+            ).exists()
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Return which of `user_ids` this user is following, in one query."""
+
+        if not user_ids:
+            return frozenset()
+
+        return frozenset(
+            user_id for (user_id,) in (
+                db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id)
+                .filter(Follows.user_being_followed_id.in_(user_ids))
+            )
+        )
+
+
+class User(FollowChecks, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -75,8 +192,68 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped whenever the profile is edited, so anything cached from the
+    # old username or images (see fragments.py) is looked up afresh.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped along with any counter below, i.e. whenever this user's
+    # messages, follows or likes change; with profile_version it tells
+    # whether pages about this user are still current (see http_caching.py).
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Denormalized counts, kept in step by the views that change them and
+    # rebuilt from scratch by `flask recount`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', backref="user")
 
+    __table_args__ = (
+        # Serves prefix searches (LIKE 'abc%'); text_pattern_ops lets
+        # PostgreSQL use it whatever the database collation.
+        db.Index(
+            'ix_users_username_prefix',
+            'username',
+            postgresql_ops={'username': 'text_pattern_ops'},
+        ),
+    )
+
     followers = db.relationship(
         "User",
         secondary="follows",
@@ -98,10 +275,11 @@ class User(db.Model):
     def signup(cls, username, email, password, image_url=DEFAULT_IMAGE_URL):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises HasherBusy if the
+        password hasher is overloaded.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -114,7 +292,7 @@ class User(db.Model):
         return user
 
     @classmethod
-    def authenticate(cls, username, password):
+    def authenticate(cls, username, password, unknown_usernames=None):
         """Find user with `username` and `password`.
 
         This is a class method (call it on the class, not an individual user.)
@@ -122,31 +300,288 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If this can't find matching user (or if password is wrong), returns
-        False.
+        False. An unknown username still costs a password check, so it
+        takes as long as a wrong password.
+
+        `unknown_usernames` is an optional cache (with get/set) of usernames
+        known not to exist; those skip the database lookup.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = None
+
+        if unknown_usernames is None or not unknown_usernames.get(username):
+            user = cls.query.filter_by(username=username).first()
+
+            if user is None and unknown_usernames is not None:
+                unknown_usernames.set(username, True)
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user is None:
+            return hasher.check_dummy(password)
+
+        if user.check_password(password):
+            return user
 
         return False
 
-    def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+    def check_password(self, password):
+        """Return whether `password` is this user's password.
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        A password hashed with an old work factor is rehashed with the
+        current one; the caller commits the change. Raises HasherBusy if
+        the password hasher is overloaded.
+        """
 
-    def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+    @classmethod
+    def search(cls, text):
+        """Return a query of users whose username matches `text`.
+
+        On PostgreSQL this is a case-insensitive substring match, served by
+        the trigram index on username. Other engines get a prefix match,
+        served by the username prefix index.
+        """
+
+        text = escape_like(text)
+
+        if db.engine.dialect.name == 'postgresql':
+            return cls.query.filter(
+                cls.username.ilike(f"%{text}%", escape='\\'))
+
+        return cls.query.filter(cls.username.like(f"{text}%", escape='\\'))
+
+    @classmethod
+    def typeahead(cls, prefix, limit=10):
+        """Return up to `limit` users whose username starts with `prefix`."""
+
+        prefix = escape_like(prefix)
+
+        return (cls.query
+                .filter(cls.username.like(f"{prefix}%", escape='\\'))
+                .order_by(cls.username)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def bump_counts(cls, user_id, **deltas):
+        """Atomically add `deltas` to counter columns of user `user_id`,
+        e.g. `User.bump_counts(5, messages_count=1)`, and bump its version.
+        """
+
+        cls.query.filter(cls.id == user_id).update(
+            {
+                cls.version: cls.version + 1,
+                **{
+                    getattr(cls, column): getattr(cls, column) + delta
+                    for column, delta in deltas.items()
+                },
+            },
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def versions(cls, *user_ids):
+        """Return {user id: (profile_version, version)} for those of
+        `user_ids` that exist, in one query.
+        """
+
+        rows = (db.session.query(cls.id, cls.profile_version, cls.version)
+                .filter(cls.id.in_(user_ids)))
+
+        return {
+            user_id: (profile_version, version)
+            for user_id, profile_version, version in rows
+        }
+
+    @classmethod
+    def uncount_likes(cls, message_ids):
+        """Decrement likes_count of everyone who liked any of `message_ids`,
+        and return their ids.
+
+        Call before deleting the messages; their likes are then removed by
+        ON DELETE CASCADE without touching the counters.
+        """
+
+        lost_likes = (
+            db.select(db.func.count())
+            .select_from(Like)
+            .where(Like.user_id == cls.id, Like.message_id.in_(message_ids))
+            .scalar_subquery()
+        )
+        likers = db.select(Like.user_id).where(Like.message_id.in_(message_ids))
+        liker_ids = {
+            user_id for (user_id,) in db.session.execute(likers.distinct())}
+
+        (cls.query
+            .filter(cls.id.in_(likers))
+            .update(
+                {
+                    cls.likes_count: cls.likes_count - lost_likes,
+                    cls.version: cls.version + 1,
+                },
+                synchronize_session=False))
+
+        return liker_ids
+
+    @classmethod
+    def uncount_user(cls, user_id):
+        """Remove user `user_id` from other users' counters, and return the
+        ids of the users whose counters changed.
+
+        Call before deleting the user; their follows, messages and the likes
+        on those messages are then removed by ON DELETE CASCADE.
+        """
+
+        followed = (
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+        )
+        followers = (
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id)
+        )
+        changed = {
+            other_id for (other_id,) in db.session.execute(
+                followed.union(followers))}
+
+        (cls.query
+            .filter(cls.id.in_(followed))
+            .update(
+                {
+                    cls.followers_count: cls.followers_count - 1,
+                    cls.version: cls.version + 1,
+                },
+                synchronize_session=False))
+
+        (cls.query
+            .filter(cls.id.in_(followers))
+            .update(
+                {
+                    cls.following_count: cls.following_count - 1,
+                    cls.version: cls.version + 1,
+                },
+                synchronize_session=False))
+
+        changed |= cls.uncount_likes(
+            db.select(Message.id).where(Message.user_id == user_id))
+
+        liked = db.select(Like.message_id).where(Like.user_id == user_id)
+        (Message.query
+            .filter(Message.id.in_(liked))
+            .update(
+                {Message.like_count: Message.like_count - 1},
+                synchronize_session=False))
+
+        changed.discard(user_id)
+        return changed
+
+    @classmethod
+    def recount(cls):
+        """Rebuild every user's counters from the source tables."""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        def count(*where):
+            return (db.select(db.func.count())
+                    .where(*where)
+                    .scalar_subquery())
+
+        cls.query.update(
+            {
+                cls.messages_count: count(Message.user_id == cls.id),
+                cls.following_count: count(Follows.user_following_id == cls.id),
+                cls.followers_count: count(
+                    Follows.user_being_followed_id == cls.id),
+                cls.likes_count: count(Like.user_id == cls.id),
+                cls.version: cls.version + 1,
+            },
+            synchronize_session=False,
+        )
+
+    def serialize(self):
+        """Serialize to a dict of public user info, for JSON responses."""
+
+        return {
+            "id": self.id,
+            "username": self.username,
+            "imageUrl": self.image_url,
+        }
+
+    def snapshot(self):
+        """Return an immutable CachedUser copy of this user's profile."""
+
+        return CachedUser(**{
+            field: getattr(self, field) for field in CachedUser._fields
+        })
+
+
+# Substring username search on PostgreSQL needs a trigram index. pg_trgm ships
+# with PostgreSQL's contrib modules; if it isn't installed the index is
+# skipped and searches fall back to a sequential scan.
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("""
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (username gin_trgm_ops);
+        EXCEPTION
+            WHEN feature_not_supported
+                OR undefined_file
+                OR insufficient_privilege THEN
+            RAISE NOTICE 'pg_trgm unavailable: %%', SQLERRM;
+        END
+        $$;
+    """).execute_if(dialect='postgresql'),
+)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in `text` (for use with escape='\\')."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+class CachedUser(FollowChecks, namedtuple('CachedUser', [
+    'id',
+    'username',
+    'email',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+    'messages_count',
+    'following_count',
+    'followers_count',
+    'likes_count',
+])):
+    """Immutable snapshot of a user's profile fields.
+
+    Cheap to cache between requests and used as `g.user`. Views that change
+    the user load the User row itself.
+    """
+
+    __slots__ = ()
+
+    def to_json(self):
+        """Serialize for a shared cache backend."""
+
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def from_json(cls, data):
+        """Inverse of `to_json`."""
+
+        return cls(**json.loads(data))
 
 
 class Message(db.Model):
@@ -176,6 +611,323 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized count of likes, kept in step by Like.toggle and
+    # Like.apply_intents (rebuild with `flask recount`)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    def serialize(self):
+        """Serialize to a dict of message info, for JSON responses."""
+
+        return {
+            "id": self.id,
+            "text": self.text,
+            "timestamp": self.timestamp.isoformat(),
+            "userId": self.user_id,
+            "username": self.user.username,
+            "imageUrl": self.user.image_url,
+            "likeCount": self.like_count,
+        }
+
+    @classmethod
+    def bump_like_counts(cls, deltas):
+        """Add `deltas` ({message id: change}) to the messages' like_count."""
+
+        for message_id, delta in deltas.items():
+            if delta:
+                cls.query.filter(cls.id == message_id).update(
+                    {cls.like_count: cls.like_count + delta},
+                    synchronize_session=False)
+
+    @classmethod
+    def recount(cls):
+        """Rebuild every message's like_count from the likes table."""
+
+        cls.query.update(
+            {
+                cls.like_count: (
+                    db.select(db.func.count())
+                    .where(Like.message_id == cls.id)
+                    .scalar_subquery()),
+            },
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def search(cls, text, before=None, per_page=20):
+        """Full-text search of message text, best match first.
+
+        Returns a page of messages and the cursor for the next page (see
+        pagination.py; `before` is a decoded rank cursor). Uses the
+        search_vector GIN index on PostgreSQL and the messages_fts FTS5
+        table on SQLite. Other engines get an unranked, case-insensitive
+        substring match, newest first.
+        """
+
+        dialect = db.engine.dialect.name
+
+        if dialect == 'postgresql':
+            search_vector = db.literal_column('messages.search_vector')
+            tsquery = db.func.websearch_to_tsquery('english', text)
+            # ts_rank is a float4; the cursor holds a float8, and comparing
+            # the two would skip or repeat rows across pages
+            rank = db.cast(
+                db.func.ts_rank(search_vector, tsquery), db.Float(53))
+            query = (db.session.query(cls, rank.label('rank'))
+                     .filter(search_vector.op('@@')(tsquery)))
+
+        elif dialect == 'sqlite':
+            fts = db.table('messages_fts', db.column('rowid'))
+            # bm25() is lower-is-better; negate so both engines sort descending
+            rank = -db.func.bm25(db.literal_column('messages_fts'))
+            query = (db.session.query(cls, rank.label('rank'))
+                     .join(fts, fts.c.rowid == cls.id)
+                     .filter(db.literal_column('messages_fts')
+                             .op('MATCH')(fts5_query(text))))
+
+        else:
+            rank = db.literal(0.0)
+            query = (db.session.query(cls, rank.label('rank'))
+                     .filter(cls.text.ilike(
+                         f"%{escape_like(text)}%", escape='\\')))
+
+        if before:
+            query = query.filter(db.tuple_(rank, cls.id) < before)
+
+        rows = (with_authors(query)
+                .order_by(rank.desc(), cls.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            last_message, last_rank = rows[-1]
+            next_cursor = encode_rank_cursor(last_rank, last_message.id)
+
+        return [msg for msg, _ in rows], next_cursor
+
+
+def fts5_query(text):
+    """Turn user input into an FTS5 query matching all of its words.
+
+    Each word is quoted so FTS5 operators and punctuation are taken
+    literally.
+    """
+
+    words = text.split()
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+
+
+# A user's messages, newest first: profile pages, timeline backfill and
+# celebrity fan-out-on-read all read this range.
+db.Index(
+    'ix_messages_user_id_timestamp',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+
+# Full-text index over message text. On PostgreSQL: a generated tsvector
+# column with a GIN index. On SQLite: an external-content FTS5 table kept in
+# step by triggers.
+for statement in [
+    """
+    ALTER TABLE messages
+        ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', text)) STORED
+    """,
+    """
+    CREATE INDEX ix_messages_search_vector
+        ON messages USING gin (search_vector)
+    """,
+]:
+    event.listen(
+        Message.__table__,
+        'after_create',
+        DDL(statement).execute_if(dialect='postgresql'),
+    )
+
+for statement in [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(
+            text, content='messages', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+    """,
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+]:
+    event.listen(
+        Message.__table__,
+        'after_create',
+        DDL(statement).execute_if(dialect='sqlite'),
+    )
+
+event.listen(
+    Message.__table__,
+    'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'),
+)
+
+
+def with_authors(query):
+    """Load the author of each message in `query` in the same SELECT.
+
+    Use for any message list that renders author names or avatars, so the
+    template doesn't issue one lazy load per author.
+    """
+
+    return query.options(db.joinedload(Message.user, innerjoin=True))
+
+
+# Result of Like.toggle
+ToggledLike = namedtuple('ToggledLike', ['author_id', 'liked', 'like_count'])
+
+# Like.toggle on PostgreSQL, in one statement. Data-modifying CTEs all see
+# the tables as they were before the statement, so the counts are adjusted
+# by what this statement deleted or inserted.
+TOGGLE_LIKE_SQL = """
+WITH message AS (
+    SELECT id, user_id, like_count FROM messages WHERE id = :message_id
+),
+deleted AS (
+    DELETE FROM likes
+    WHERE user_id = :user_id AND message_id = :message_id
+    RETURNING message_id
+),
+inserted AS (
+    INSERT INTO likes (user_id, message_id, created_at)
+    SELECT :user_id, id, :now FROM message
+    WHERE user_id != :user_id AND NOT EXISTS (SELECT FROM deleted)
+    ON CONFLICT DO NOTHING
+    RETURNING message_id
+),
+changed AS (
+    SELECT
+        (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted)
+        AS delta
+),
+counted AS (
+    UPDATE users
+    SET likes_count = likes_count + changed.delta, version = version + 1
+    FROM changed
+    WHERE id = :user_id
+        AND (EXISTS (SELECT FROM deleted) OR EXISTS (SELECT FROM inserted))
+),
+message_counted AS (
+    UPDATE messages
+    SET like_count = like_count + changed.delta
+    FROM changed
+    WHERE id = :message_id AND changed.delta != 0
+    RETURNING like_count
+)
+SELECT
+    message.user_id,
+    message.user_id != :user_id AND NOT EXISTS (SELECT FROM deleted),
+    coalesce((SELECT like_count FROM message_counted), message.like_count)
+FROM message, changed
+"""
+
+
+# First half of Like.apply_intents on PostgreSQL: records when each intent
+# was made on its like_stamps row, unless a newer one has been applied
+# already, and returns the (user id, message id) pairs to go ahead with.
+# {values} is a list of (:u0, :m0, :t0), ... rows. The rows stay locked until
+# commit, so a concurrent apply for the same pair waits, then sees this one.
+STAMP_LIKE_INTENTS_SQL = """
+WITH intents (user_id, message_id, recorded_at) AS (
+    VALUES {values}
+)
+INSERT INTO like_stamps AS stamps (user_id, message_id, recorded_at)
+SELECT intents.user_id, intents.message_id, intents.recorded_at
+FROM intents
+JOIN messages ON messages.id = intents.message_id
+JOIN users ON users.id = intents.user_id
+ORDER BY intents.user_id, intents.message_id
+ON CONFLICT (user_id, message_id) DO UPDATE
+    SET recorded_at = excluded.recorded_at
+    WHERE stamps.recorded_at < excluded.recorded_at
+RETURNING user_id, message_id
+"""
+
+
+# The rest of Like.apply_intents on PostgreSQL, in one statement. {values} is
+# a list of (:u0, :m0, :l0, :t0), ... rows: user id, message id, whether it
+# should be liked, and when that was asked for. Intents for messages or users
+# deleted since are dropped, as are likes of one's own messages.
+APPLY_LIKE_INTENTS_SQL = """
+WITH intents (user_id, message_id, liked, recorded_at) AS (
+    VALUES {values}
+),
+inserted AS (
+    INSERT INTO likes (user_id, message_id, created_at)
+    SELECT intents.user_id, intents.message_id, intents.recorded_at
+    FROM intents
+    JOIN messages ON messages.id = intents.message_id
+    JOIN users ON users.id = intents.user_id
+    WHERE intents.liked AND messages.user_id != intents.user_id
+    ON CONFLICT DO NOTHING
+    RETURNING user_id, message_id
+),
+deleted AS (
+    DELETE FROM likes
+    USING intents
+    WHERE NOT intents.liked
+        AND likes.user_id = intents.user_id
+        AND likes.message_id = intents.message_id
+    RETURNING likes.user_id, likes.message_id
+),
+changes AS (
+    SELECT user_id, message_id, 1 AS delta FROM inserted
+    UNION ALL
+    SELECT user_id, message_id, -1 FROM deleted
+),
+message_counted AS (
+    UPDATE messages
+    SET like_count = like_count + message_deltas.delta
+    FROM (
+        SELECT message_id, sum(delta) AS delta
+        FROM changes
+        GROUP BY message_id
+    ) AS message_deltas
+    WHERE messages.id = message_deltas.message_id
+),
+deltas AS (
+    SELECT user_id, sum(delta) AS delta
+    FROM changes
+    GROUP BY user_id
+)
+UPDATE users
+SET likes_count = likes_count + deltas.delta, version = version + 1
+FROM deltas
+WHERE users.id = deltas.user_id
+RETURNING users.id
+"""
+
+
 class Like(db.Model):
     """Connection of users <-> messages."""
 
@@ -193,6 +945,715 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # When the like was made (asked for, if it was buffered); liked
+    # messages are listed newest-liked first
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.current_timestamp(),
+    )
+
+    __table_args__ = (
+        # The primary key leads with the user ("what did X like"); this
+        # serves the reverse, "who liked message Y".
+        db.Index('ix_likes_message_id', 'message_id', 'user_id'),
+        # A user's likes in the order they were made, for paging them
+        db.Index(
+            'ix_likes_user_id_created_at',
+            'user_id', 'created_at', 'message_id',
+        ),
+    )
+
+    @classmethod
+    def message_ids_for(cls, user_id):
+        """Return the ids of every message liked by `user_id`.
+
+        Reads only the likes table; no Message rows are loaded.
+        """
+
+        return frozenset(
+            message_id for (message_id,) in (
+                db.session.query(cls.message_id).filter(cls.user_id == user_id)
+            )
+        )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like message `message_id` for `user_id`, or unlike it if they
+        already do, and keep their likes_count in step.
+
+        Returns a ToggledLike of the message's author, whether the user
+        likes it now and how many likes it has, or None if there is no such
+        message. Users can't like their own messages.
+
+        On PostgreSQL this is one statement, so concurrent toggles can't
+        both insert (or both delete) and the counts can't drift.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            # Plain SQL doesn't autoflush; send any pending likes first
+            db.session.flush()
+            row = db.session.execute(
+                db.text(TOGGLE_LIKE_SQL),
+                {
+                    'user_id': user_id,
+                    'message_id': message_id,
+                    'now': datetime.utcnow(),
+                },
+            ).first()
+
+            return None if row is None else ToggledLike(*row)
+
+        author_id = (db.session.query(Message.user_id)
+                     .filter(Message.id == message_id)
+                     .scalar())
+        if author_id is None:
+            return None
+
+        liked = False
+        delta = -(cls.query
+                  .filter_by(user_id=user_id, message_id=message_id)
+                  .delete(synchronize_session=False))
+
+        if not delta and author_id != user_id:
+            liked = True
+            delta = db.session.execute(
+                db.insert(cls)
+                .prefix_with('OR IGNORE', dialect='sqlite')
+                .values(user_id=user_id, message_id=message_id)
+            ).rowcount
+
+        if delta:
+            User.bump_counts(user_id, likes_count=delta)
+            Message.bump_like_counts({message_id: delta})
+
+        like_count = (db.session.query(Message.like_count)
+                      .filter(Message.id == message_id)
+                      .scalar())
+
+        return ToggledLike(author_id, liked, like_count)
+
+    @classmethod
+    def set_liked(cls, user_id, message_id, liked, recorded_at=None):
+        """Like message `message_id` for `user_id` if `liked`, otherwise
+        unlike it, keeping the counts in step. Doing it twice changes
+        nothing.
+
+        `recorded_at` is when the user asked (default: now); see
+        `apply_intents`.
+
+        Returns a ToggledLike, as `toggle` does, or None if there is no
+        such message.
+        """
+
+        author_id = (db.session.query(Message.user_id)
+                     .filter(Message.id == message_id)
+                     .scalar())
+        if author_id is None:
+            return None
+
+        if author_id != user_id:
+            cls.apply_intents([(
+                user_id, message_id, liked,
+                recorded_at or datetime.utcnow())])
+
+        like_count = (db.session.query(Message.like_count)
+                      .filter(Message.id == message_id)
+                      .scalar())
+
+        return ToggledLike(
+            author_id, liked and author_id != user_id, like_count)
+
+    @classmethod
+    def apply_intents(cls, intents):
+        """Bring the likes table in line with `intents`, a list of
+        (user_id, message_id, liked, recorded_at) with at most one entry per
+        pair, and keep the users' likes_count in step.
+
+        An intent older than the last one applied for its pair (see
+        LikeStamp) is skipped, so buffers written in any order, or journals
+        replayed late, leave the state the user asked for last. Applying
+        the same intents twice changes nothing the second time.
+
+        Returns the ids of the users whose likes changed. Like counts of
+        the messages are kept in step too.
+        """
+
+        if not intents:
+            return set()
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.flush()
+            params = {}
+            for i, (user_id, message_id, _, recorded_at) in enumerate(
+                    intents):
+                params.update({
+                    f'u{i}': user_id, f'm{i}': message_id,
+                    f't{i}': recorded_at})
+
+            values = ', '.join(
+                f'(CAST(:u{i} AS integer), CAST(:m{i} AS integer), '
+                f'CAST(:t{i} AS timestamp))'
+                for i in range(len(intents)))
+            newer = {
+                tuple(pair) for pair in db.session.execute(
+                    db.text(STAMP_LIKE_INTENTS_SQL.format(values=values)),
+                    params)
+            }
+
+            intents = [intent for intent in intents if intent[:2] in newer]
+            if not intents:
+                return set()
+
+            params = {}
+            for i, (user_id, message_id, liked, recorded_at) in enumerate(
+                    intents):
+                params.update({
+                    f'u{i}': user_id, f'm{i}': message_id, f'l{i}': liked,
+                    f't{i}': recorded_at})
+
+            values = ', '.join(
+                f'(CAST(:u{i} AS integer), CAST(:m{i} AS integer), '
+                f'CAST(:l{i} AS boolean), CAST(:t{i} AS timestamp))'
+                for i in range(len(intents)))
+
+            return {
+                user_id for (user_id,) in db.session.execute(
+                    db.text(APPLY_LIKE_INTENTS_SQL.format(values=values)),
+                    params)
+            }
+
+        authors = dict(
+            db.session.query(Message.id, Message.user_id)
+            .filter(Message.id.in_({intent[1] for intent in intents})))
+        deltas = Counter()
+        message_deltas = Counter()
+
+        for user_id, message_id, liked, recorded_at in intents:
+            if message_id not in authors:
+                continue
+
+            stamp = db.session.get(LikeStamp, (user_id, message_id))
+            if stamp is None:
+                db.session.add(LikeStamp(
+                    user_id=user_id,
+                    message_id=message_id,
+                    recorded_at=recorded_at))
+            elif stamp.recorded_at < recorded_at:
+                stamp.recorded_at = recorded_at
+            else:
+                continue
+
+            delta = 0
+            if not liked:
+                delta = -(cls.query
+                          .filter_by(user_id=user_id, message_id=message_id)
+                          .delete(synchronize_session=False))
+
+            elif authors[message_id] != user_id:
+                delta = db.session.execute(
+                    db.insert(cls)
+                    .prefix_with('OR IGNORE', dialect='sqlite')
+                    .values(
+                        user_id=user_id,
+                        message_id=message_id,
+                        created_at=recorded_at)
+                ).rowcount
+
+            deltas[user_id] += delta
+            message_deltas[message_id] += delta
+
+        changed = {user_id for user_id, delta in deltas.items() if delta}
+        for user_id in changed:
+            User.bump_counts(user_id, likes_count=deltas[user_id])
+        Message.bump_like_counts(message_deltas)
+
+        return changed
+
+    @classmethod
+    def likers(cls, message_id, after=None, per_page=30):
+        """Return a page of the users who liked `message_id`, in user id
+        order, and the user id to continue after (None on the last page).
+
+        Reads ix_likes_message_id from `after` onwards, so each page costs
+        the same however many likes the message has.
+        """
+
+        query = (db.session.query(User)
+                 .join(cls, cls.user_id == User.id)
+                 .filter(cls.message_id == message_id))
+
+        if after is not None:
+            query = query.filter(cls.user_id > after)
+
+        users = query.order_by(cls.user_id).limit(per_page + 1).all()
+
+        if len(users) <= per_page:
+            return users, None
+
+        users = users[:per_page]
+        return users, users[-1].id
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Return which of `message_ids` have been liked by `user_id`.
+
+        One primary-key lookup per id, however many likes the user has.
+        """
+
+        if not message_ids:
+            return frozenset()
+
+        return frozenset(
+            message_id for (message_id,) in (
+                db.session.query(cls.message_id)
+                .filter(cls.user_id == user_id)
+                .filter(cls.message_id.in_(message_ids))
+            )
+        )
+
+
+class LikeStamp(db.Model):
+    """When the newest like or unlike applied for a (user, message) was
+    asked for.
+
+    Likes can be written late (see like_buffer.py); an intent older than
+    its stamp is one the user has since changed their mind about.
+    """
+
+    __tablename__ = 'like_stamps'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recorded_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class TimelineBackfill(db.Model):
+    """An author who stopped being a celebrity, whose recent messages still
+    need copying into their followers' home timelines.
+
+    Until `flask backfill-timelines` has done it, their messages are merged
+    into home feeds when read, as a celebrity's are.
+    """
+
+    __tablename__ = 'timeline_backfills'
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+
+class HomeTimeline(db.Model):
+    """Materialized home feed: one row per (reader, message).
+
+    Rows are written when a message is posted ("fan-out-on-write"), so the
+    homepage reads one pre-sorted slice instead of joining through follows.
+    Authors with more followers than the celebrity threshold are not fanned
+    out; their messages are merged in when the feed is read, and copied to
+    their followers (see TimelineBackfill) if they drop back below it.
+
+    Each timeline keeps its newest TIMELINE_SIZE entries, once
+    `flask trim-timelines` has cut off the rest.
+    """
+
+    __tablename__ = 'home_timeline'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_home_timeline_user_id_timestamp',
+            'user_id', 'timestamp', 'message_id',
+        ),
+    )
+
+    @staticmethod
+    def celebrity_ids(user_ids, celebrity_threshold):
+        """Return the ids among `user_ids` with more followers than
+        `celebrity_threshold`.
+        """
+
+        return {
+            user_id for (user_id,) in (
+                db.session.query(User.id)
+                .filter(User.id.in_(user_ids))
+                .filter(User.followers_count > celebrity_threshold)
+            )
+        }
+
+    @classmethod
+    def fan_out(cls, message, celebrity_threshold):
+        """Add a new message to its author's timeline and, unless the author
+        is a celebrity, to the timeline of every follower.
+
+        The message must already be flushed so it has an id and timestamp.
+        """
+
+        db.session.add(cls(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp,
+        ))
+
+        if cls.celebrity_ids([message.user_id], celebrity_threshold):
+            return
+
+        followers = (
+            db.select(
+                Follows.user_following_id,
+                db.literal(message.id),
+                db.literal(message.user_id),
+                db.literal(message.timestamp, db.DateTime),
+            )
+            .where(Follows.user_being_followed_id == message.user_id)
+            .where(Follows.user_following_id != message.user_id)
+        )
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                followers,
+            )
+        )
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, celebrity_threshold):
+        """Copy the recent messages of `followed_id` into the timeline of
+        `user_id` after a new follow.
+        """
+
+        if (user_id == followed_id
+                or cls.celebrity_ids([followed_id], celebrity_threshold)):
+            return
+
+        recent = (
+            db.select(
+                db.literal(user_id),
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+            )
+            .where(Message.user_id == followed_id)
+            .order_by(Message.timestamp.desc())
+            .limit(TIMELINE_BACKFILL_SIZE)
+        )
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent,
+            )
+        )
+
+    @classmethod
+    def queue_backfills(cls, author_ids, celebrity_threshold):
+        """Queue a TimelineBackfill for any of `author_ids` who just stopped
+        being a celebrity.
+
+        Call after each of `author_ids` has lost one follower: those left
+        with exactly `celebrity_threshold` followers were celebrities until
+        then, so their latest messages were never fanned out.
+        """
+
+        if not author_ids:
+            return
+
+        columns = ['author_id']
+        former_celebrities = (
+            db.select(User.id)
+            .where(User.id.in_(author_ids))
+            .where(User.followers_count == celebrity_threshold)
+        )
+        dialect = db.engine.dialect.name
+
+        if dialect == 'postgresql':
+            statement = postgresql.insert(TimelineBackfill).from_select(
+                columns, former_celebrities).on_conflict_do_nothing()
+        elif dialect == 'sqlite':
+            statement = sqlite.insert(TimelineBackfill).from_select(
+                columns, former_celebrities).on_conflict_do_nothing()
+        else:
+            statement = db.insert(TimelineBackfill).from_select(
+                columns,
+                former_celebrities.where(~db.exists().where(
+                    TimelineBackfill.author_id == User.id)),
+            )
+
+        db.session.execute(statement)
+
+    @classmethod
+    def run_next_backfill(cls, celebrity_threshold):
+        """Take one queued TimelineBackfill and copy the author's recent
+        messages into the timelines of all their followers, unless they are
+        a celebrity again. Returns the author's id, or None if the queue is
+        empty; the caller commits.
+
+        This can write TIMELINE_BACKFILL_SIZE rows per follower, so it runs
+        from `flask backfill-timelines` rather than in a request.
+        """
+
+        author_id = (
+            db.session.query(TimelineBackfill.author_id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar()
+        )
+        if author_id is None:
+            return None
+
+        TimelineBackfill.query.filter_by(author_id=author_id).delete()
+
+        if cls.celebrity_ids([author_id], celebrity_threshold):
+            return author_id
+
+        recent = (
+            db.select(Message.id, Message.timestamp)
+            .where(Message.user_id == author_id)
+            .order_by(Message.timestamp.desc())
+            .limit(TIMELINE_BACKFILL_SIZE)
+            .subquery()
+        )
+        already_there = (
+            db.exists()
+            .where(cls.user_id == Follows.user_following_id)
+            .where(cls.message_id == recent.c.id)
+        )
+        missing = (
+            db.select(
+                Follows.user_following_id,
+                recent.c.id,
+                db.literal(author_id),
+                recent.c.timestamp,
+            )
+            # Every follower gets every one of the messages
+            .select_from(db.join(Follows, recent, db.true()))
+            .where(Follows.user_being_followed_id == author_id)
+            .where(Follows.user_following_id != author_id)
+            .where(~already_there)
+        )
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                missing,
+            )
+        )
+
+        return author_id
+
+    @classmethod
+    def trim(cls):
+        """Cut every timeline down to its newest TIMELINE_SIZE entries;
+        return how many were removed.
+        """
+
+        too_long = (
+            db.session.query(cls.user_id)
+            .group_by(cls.user_id)
+            .having(db.func.count() > TIMELINE_SIZE)
+            .all()
+        )
+
+        removed = 0
+        for (user_id,) in too_long:
+            oldest_kept = (
+                db.session.query(cls.timestamp, cls.message_id)
+                .filter(cls.user_id == user_id)
+                .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                .offset(TIMELINE_SIZE - 1)
+                .limit(1)
+                .one()
+            )
+            removed += (
+                cls.query
+                .filter(cls.user_id == user_id)
+                .filter(db.tuple_(cls.timestamp, cls.message_id)
+                        < tuple(oldest_kept))
+                .delete(synchronize_session=False)
+            )
+
+        return removed
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove messages of `followed_id` from the timeline of `user_id`."""
+
+        (cls.query
+            .filter(cls.user_id == user_id, cls.author_id == followed_id)
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, celebrity_threshold):
+        """Rebuild every timeline from follows and messages, keeping the
+        newest TIMELINE_SIZE entries of each (used by seed and
+        `flask rebuild-timelines`).
+        """
+
+        cls.query.delete()
+
+        # No timeline keeps more than this many messages of one author
+        recent = (
+            db.select(
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+                db.func.row_number().over(
+                    partition_by=Message.user_id,
+                    order_by=(Message.timestamp.desc(), Message.id.desc()),
+                ).label('rank'),
+            )
+            .subquery()
+        )
+
+        # Whose timelines each author's messages go in: their own, and
+        # unless they're a celebrity, their followers'
+        celebrities = (
+            db.select(User.id)
+            .where(User.followers_count > celebrity_threshold)
+        )
+        readers = db.union_all(
+            db.select(User.id.label('user_id'), User.id.label('author_id')),
+            db.select(
+                Follows.user_following_id,
+                Follows.user_being_followed_id,
+            )
+            .where(Follows.user_following_id != Follows.user_being_followed_id)
+            .where(Follows.user_being_followed_id.not_in(celebrities)),
+        ).subquery()
+
+        entries = (
+            db.select(
+                readers.c.user_id,
+                recent.c.id,
+                recent.c.user_id.label('author_id'),
+                recent.c.timestamp,
+                db.func.row_number().over(
+                    partition_by=readers.c.user_id,
+                    order_by=(recent.c.timestamp.desc(), recent.c.id.desc()),
+                ).label('rank'),
+            )
+            .join(recent, recent.c.user_id == readers.c.author_id)
+            .where(recent.c.rank <= TIMELINE_SIZE)
+            .subquery()
+        )
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                db.select(
+                    entries.c.user_id,
+                    entries.c.id,
+                    entries.c.author_id,
+                    entries.c.timestamp,
+                )
+                .where(entries.c.rank <= TIMELINE_SIZE),
+            )
+        )
+
+    @classmethod
+    def feed(cls, user_id, celebrity_threshold, before=None, per_page=20):
+        """Return a page of the home feed for `user_id` and the cursor for
+        the next page (see pagination.py).
+
+        Reads the materialized timeline and merges in messages from any
+        followed celebrities (fan-out-on-read).
+        """
+
+        timeline = with_authors(
+            Message.query
+            .join(cls, cls.message_id == Message.id)
+            .filter(cls.user_id == user_id)
+        )
+        if before:
+            timeline = timeline.filter(
+                db.tuple_(cls.timestamp, cls.message_id) < before)
+        messages = (
+            timeline
+            .order_by(cls.timestamp.desc(), cls.message_id.desc())
+            .limit(per_page + 1)
+            .all()
+        )
+
+        # Celebrities, and authors whose backfill hasn't run yet
+        followed_ids = (
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+        )
+        celebrity_ids = {
+            author_id for (author_id,) in (
+                db.session.query(User.id)
+                .filter(User.id.in_(followed_ids))
+                .filter(db.or_(
+                    User.followers_count > celebrity_threshold,
+                    User.id.in_(db.select(TimelineBackfill.author_id)),
+                ))
+            )
+        }
+
+        if not celebrity_ids:
+            return page_and_cursor(messages, per_page)
+
+        celebrity_messages = with_authors(
+            Message.query
+            .filter(Message.user_id.in_(celebrity_ids))
+        )
+        if before:
+            celebrity_messages = celebrity_messages.filter(
+                db.tuple_(Message.timestamp, Message.id) < before)
+        celebrity_messages = (
+            celebrity_messages
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(per_page + 1)
+            .all()
+        )
+
+        feed = []
+        seen = set()
+        for msg in merge(
+                messages,
+                celebrity_messages,
+                key=lambda msg: (msg.timestamp, msg.id),
+                reverse=True):
+            if msg.id not in seen:
+                seen.add(msg.id)
+                feed.append(msg)
+
+        return page_and_cursor(feed, per_page)
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -202,3 +1663,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
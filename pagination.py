@@ -0,0 +1,102 @@
+"""Keyset (cursor) pagination for Warbler message lists.
+
+Pages are ordered newest first on (timestamp, id). A cursor is the
+(timestamp, id) of the last row on a page; the next page is everything
+strictly older than it. Unlike OFFSET, the database can seek straight to the
+cursor in an index, so page 1,000 costs the same as page 1.
+
+Search results are paged the same way on (rank, id), and liked messages on
+(when they were liked, id).
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, id):
+    """Encode a (timestamp, id) position as an opaque string."""
+
+    return f"{timestamp.isoformat()}_{id}"
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from `encode_cursor`; None if there isn't one.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    if not cursor:
+        return None
+
+    timestamp, _, id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+def encode_rank_cursor(rank, id):
+    """Encode a (search rank, id) position as an opaque string."""
+
+    return f"{rank!r}_{id}"
+
+
+def decode_rank_cursor(cursor):
+    """Decode a cursor from `encode_rank_cursor`; None if there isn't one.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    if not cursor:
+        return None
+
+    rank, _, id = cursor.rpartition('_')
+    return float(rank), int(id)
+
+
+def keyset_page(query, timestamp_col, id_col, before, per_page):
+    """Return one page of `query`, newest first, and the cursor for the next.
+
+    `before` is a decoded cursor (or None for the first page). The next
+    cursor is None when there are no older rows.
+    """
+
+    rows = _seek(query, timestamp_col, id_col, before, per_page).all()
+    return page_and_cursor(rows, per_page)
+
+
+def keyset_page_by(query, timestamp_col, id_col, before, per_page):
+    """keyset_page for rows positioned by columns other than their own
+    `timestamp` and `id`, e.g. liked messages by when they were liked.
+    """
+
+    rows = _seek(
+        query.add_columns(timestamp_col, id_col),
+        timestamp_col, id_col, before, per_page,
+    ).all()
+    items = [row[0] for row in rows]
+
+    if len(rows) <= per_page:
+        return items, None
+
+    return items[:per_page], encode_cursor(*rows[per_page - 1][1:])
+
+
+def _seek(query, timestamp_col, id_col, before, per_page):
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < before)
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1))
+
+
+def page_and_cursor(messages, per_page):
+    """Split an over-fetched, newest-first list of messages into a page and
+    the cursor for the page after it.
+    """
+
+    if len(messages) <= per_page:
+        return messages, None
+
+    page = messages[:per_page]
+    last = page[-1]
+    return page, encode_cursor(last.timestamp, last.id)
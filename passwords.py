@@ -0,0 +1,155 @@
+"""Password hashing for Warbler, off the request threads.
+
+bcrypt is slow on purpose, and it holds the CPU (and the GIL) while it
+works. PasswordHasher runs it in a pool of worker processes. Only a
+bounded number of hashes may be waiting or running at once, so a burst of
+logins gets a quick HasherBusy instead of tying up every request thread.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+import bcrypt
+
+from metrics import Counter, Histogram
+
+hash_seconds = Histogram(
+    'warbler_password_hash_seconds',
+    "Time to hash or check a password, including time queued.",
+    labelnames=('operation',))
+
+hash_rejections = Counter(
+    'warbler_password_hash_rejected_total',
+    "Password hashes refused because the hasher was busy.")
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+def _hash(password, log_rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(log_rounds))
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """bcrypt hashing in a process pool, as a Flask extension.
+
+    Config:
+
+    - BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes. Hashes made
+      with another factor report `needs_rehash`.
+    - PASSWORD_HASH_WORKERS: worker processes; 0 hashes on the calling
+      thread instead (handy for tests and scripts).
+    - PASSWORD_HASH_QUEUE_SIZE: most hashes waiting or running at once.
+    - PASSWORD_HASH_QUEUE_TIMEOUT: seconds to wait for a free slot before
+      raising HasherBusy.
+    """
+
+    def __init__(self, app=None):
+        self.log_rounds = 12
+        self.workers = 0
+        self.queue_timeout = 0
+        self._slots = None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = Lock()
+        self._dummy_hash = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.get(
+            'PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        self.queue_timeout = app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 1)
+        self._slots = BoundedSemaphore(
+            app.config.get('PASSWORD_HASH_QUEUE_SIZE', self.workers * 4 or 1))
+
+        # Made here rather than on the first unknown username, so that login
+        # doesn't take one hash longer than the rest
+        self._dummy_hash = _hash(
+            os.urandom(16).hex().encode(), self.log_rounds).decode()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` (a str) as a str."""
+
+        hashed = self._run('hash', _hash, password.encode(), self.log_rounds)
+        return hashed.decode()
+
+    def check(self, hashed, password):
+        """Return whether `password` matches the bcrypt hash `hashed`."""
+
+        return self._run('check', _check, hashed.encode(), password.encode())
+
+    def check_dummy(self, password):
+        """Check `password` against a throwaway hash; always False.
+
+        For logins with an unknown username, so they take as long as ones
+        with a wrong password and don't reveal which usernames exist.
+        """
+
+        self.check(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """Return whether `hashed` was made with a different work factor."""
+
+        # bcrypt hashes look like $2b$12$<salt and hash>
+        return int(hashed.split('$')[2]) != self.log_rounds
+
+    def _run(self, operation, function, *args):
+        start = perf_counter()
+
+        try:
+            if not self.workers:
+                return function(*args)
+
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                hash_rejections.inc()
+                raise HasherBusy()
+
+            try:
+                return self._submit(function, *args)
+            finally:
+                self._slots.release()
+
+        finally:
+            hash_seconds.observe(perf_counter() - start, operation=operation)
+
+    def _submit(self, function, *args):
+        # A pool whose worker died (e.g. killed for memory) is broken for
+        # good; start a new one and try once more.
+        pool = self._get_pool()
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            self._drop_pool(pool)
+            return self._get_pool().submit(function, *args).result()
+
+    def _drop_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+
+        pool.shutdown(wait=False)
+
+    def _get_pool(self):
+        # Started on first use, and again in any process forked after that,
+        # since a pool can't be shared across a fork.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context('spawn'))
+                self._pool_pid = os.getpid()
+
+            return self._pool
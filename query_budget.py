@@ -0,0 +1,47 @@
+"""Test helper: fail if a block of code issues too many SQL statements.
+
+Use in tests like:
+
+    with assert_query_budget(db.engine, 4):
+        c.get("/")
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryRecorder:
+    """Records the SQL statements executed on an engine while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def assert_query_budget(engine, budget):
+    """Raise AssertionError if the block runs more than `budget` statements."""
+
+    with QueryRecorder(engine) as recorder:
+        yield recorder
+
+    if recorder.count > budget:
+        statements = "\n\n".join(recorder.statements)
+        raise AssertionError(
+            f"{recorder.count} queries issued, budget was {budget}:\n\n"
+            f"{statements}")
@@ -0,0 +1,161 @@
+"""Token-bucket rate limiting for Warbler.
+
+Each key (an IP address, a username, ...) has a bucket holding up to
+`capacity` tokens that refills at `per_second` tokens a second. An attempt
+spends a token; with no tokens left it is refused.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+try:
+    import redis
+except ImportError:  # only needed for a redis:// store
+    redis = None
+
+
+def _refill(tokens, updated_at, now, capacity, per_second):
+    return min(capacity, tokens + (now - updated_at) * per_second)
+
+
+class MemoryStore:
+    """Buckets kept in this process. Not shared between processes; holds at
+    most `maxsize` buckets, dropping the least recently used.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def peek(self, key, capacity, per_second):
+        """Return whether the bucket for `key` has a token, without
+        spending one or creating the bucket.
+        """
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+
+        if bucket is None:
+            return True
+
+        return _refill(*bucket, time(), capacity, per_second) >= 1
+
+    def take(self, key, capacity, per_second, cost=1):
+        """Spend `cost` tokens from the bucket for `key` if it has them.
+
+        Returns whether it did. With a cost of 0 nothing is spent; the
+        result says whether a token is available.
+        """
+
+        now = time()
+
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = _refill(tokens, updated_at, now, capacity, per_second)
+
+            allowed = tokens >= max(cost, 1)
+            if allowed:
+                tokens -= cost
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+            return allowed
+
+    def clear(self):
+        """Forget every bucket."""
+
+        with self._lock:
+            self._buckets.clear()
+
+
+# Same logic as MemoryStore.take, run atomically inside Redis.
+REDIS_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local per_second = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * per_second)
+
+local allowed = tokens >= math.max(cost, 1)
+if allowed then
+    tokens = tokens - cost
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / per_second) + 1)
+
+return allowed and 1 or 0
+"""
+
+
+class RedisStore:
+    """Buckets shared between processes in Redis (needs the `redis`
+    package).
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The redis package is needed for a redis:// store")
+
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(REDIS_TAKE_SCRIPT)
+
+    def peek(self, key, capacity, per_second):
+        tokens, updated_at = self._redis.hmget(key, 'tokens', 'updated_at')
+        if tokens is None:
+            return True
+
+        return _refill(
+            float(tokens), float(updated_at), time(), capacity, per_second) >= 1
+
+    def take(self, key, capacity, per_second, cost=1):
+        return bool(self._take(
+            keys=[key], args=[capacity, per_second, cost, time()]))
+
+
+def store_from_url(url):
+    """Return the bucket store for `url`: in memory if it is empty or
+    `memory://`, Redis for `redis://...`.
+    """
+
+    if not url or url.startswith('memory://'):
+        return MemoryStore()
+
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+
+    raise ValueError(f"Unsupported rate limit store URL: {url}")
+
+
+class RateLimiter:
+    """Token buckets with one capacity and refill rate, in `store`."""
+
+    def __init__(self, store, prefix, capacity, per_minute):
+        self.store = store
+        self.prefix = prefix
+        self.capacity = capacity
+        self.per_minute = per_minute
+
+    def allow(self, key):
+        """Spend a token for `key`; return False if there was none."""
+
+        return self.store.take(
+            f"{self.prefix}{key}", self.capacity, self.per_minute / 60)
+
+    def blocked(self, key):
+        """Return whether `key` is out of tokens. Read-only: spends nothing
+        and doesn't create a bucket for a key that has none.
+        """
+
+        return not self.store.peek(
+            f"{self.prefix}{key}", self.capacity, self.per_minute / 60)
@@ -1,19 +1,220 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+On PostgreSQL the CSVs are streamed in with COPY FROM STDIN; on other
+databases they are inserted in batches with executemany. Secondary indexes
+and foreign keys are dropped for the load and put back afterwards.
 
-db.drop_all()
-db.create_all()
+    python3 seed.py [--csv-dir generator] [--batch-size 10000]
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import csv
+import os
+from time import perf_counter
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app, db
+from models import User, Message, Follows, Like, HomeTimeline
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+# Load order, so foreign keys always point at rows that are already there.
+TABLES = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+    ('likes.csv', Like.__table__),
+]
 
-db.session.commit()
+# Bytes read from a CSV per round trip when streaming it with COPY.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def report(what, rows, start):
+    """Print how many rows a step handled and how fast."""
+
+    elapsed = perf_counter() - start
+    rate = rows / elapsed if elapsed else 0
+    print(f"{what}: {rows:,} rows in {elapsed:.1f}s ({rate:,.0f} rows/s)")
+
+
+def copy_csv(csv_file, table):
+    """Stream `csv_file` into `table` with COPY; return the row count."""
+
+    columns = next(csv.reader([csv_file.readline()]))
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        csv_file,
+        size=COPY_CHUNK_SIZE,
+    )
+    return cursor.rowcount
+
+
+def insert_csv(csv_file, table, batch_size):
+    """Insert `csv_file` into `table` in executemany batches; return the row
+    count.
+    """
+
+    reader = csv.DictReader(csv_file)
+    insert = db.text(
+        f"INSERT INTO {table.name} ({', '.join(reader.fieldnames)}) "
+        f"VALUES ({', '.join(':' + name for name in reader.fieldnames)})")
+
+    rows = 0
+    batch = []
+
+    for row in reader:
+        batch.append(row)
+
+        if len(batch) == batch_size:
+            db.session.execute(insert, batch)
+            rows += len(batch)
+            batch = []
+
+    if batch:
+        db.session.execute(insert, batch)
+        rows += len(batch)
+
+    return rows
+
+
+def defer_indexes(tables):
+    """Drop the secondary indexes on `tables` (and on PostgreSQL, their
+    foreign keys); return a function that puts them back.
+
+    Building an index or checking a foreign key once over the loaded rows is
+    much faster than keeping it up to date row by row.
+    """
+
+    names = [table.name for table in tables]
+
+    if db.engine.dialect.name == 'postgresql':
+        # pg_indexes also has the indexes made by DDL events (search,
+        # trigram), which SQLAlchemy's metadata doesn't know about.
+        indexes = db.session.execute(db.text("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema()
+              AND tablename IN :tables
+              AND indexname NOT IN (SELECT conname FROM pg_constraint)
+        """).bindparams(db.bindparam('tables', expanding=True)),
+            {'tables': names}).all()
+
+        foreign_keys = db.session.execute(db.text("""
+            SELECT conrelid::regclass::text, conname,
+                   pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE contype = 'f' AND conrelid::regclass::text IN :tables
+        """).bindparams(db.bindparam('tables', expanding=True)),
+            {'tables': names}).all()
+
+        for name, _ in indexes:
+            db.session.execute(db.text(f"DROP INDEX {name}"))
+
+        for table, name, _ in foreign_keys:
+            db.session.execute(
+                db.text(f"ALTER TABLE {table} DROP CONSTRAINT {name}"))
+
+        def restore():
+            for _, definition in indexes:
+                db.session.execute(db.text(definition))
+
+            for table, name, definition in foreign_keys:
+                db.session.execute(db.text(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}"))
+
+        return restore
+
+    indexes = [index for table in tables for index in table.indexes]
+
+    for index in indexes:
+        index.drop(db.session.connection())
+
+    def restore():
+        for index in indexes:
+            index.create(db.session.connection())
+
+    return restore
+
+
+def reset_sequences():
+    """Move the id sequences past the largest ids loaded (PostgreSQL only),
+    in case the CSVs carried their own ids.
+    """
+
+    for table in (User.__table__, Message.__table__):
+        db.session.execute(db.text(f"""
+            SELECT setval(
+                pg_get_serial_sequence('{table.name}', 'id'),
+                COALESCE(MAX(id), 0) + 1,
+                false)
+            FROM {table.name}
+        """))
+
+
+def seed(csv_dir, batch_size):
+    """Recreate the tables and load the CSVs in `csv_dir` into them."""
+
+    db.drop_all()
+    db.create_all()
+
+    use_copy = db.engine.dialect.name == 'postgresql'
+
+    restore_indexes = defer_indexes([table for _, table in TABLES])
+    db.session.commit()
+
+    for filename, table in TABLES:
+        path = os.path.join(csv_dir, filename)
+        if not os.path.exists(path):
+            continue
+
+        start = perf_counter()
+        with open(path, newline='') as csv_file:
+            if use_copy:
+                rows = copy_csv(csv_file, table)
+            else:
+                rows = insert_csv(csv_file, table, batch_size)
+        db.session.commit()
+        report(f"Loaded {filename}", rows, start)
+
+    if use_copy:
+        reset_sequences()
+
+    start = perf_counter()
+    restore_indexes()
+    db.session.commit()
+    print(f"Rebuilt indexes and foreign keys in {perf_counter() - start:.1f}s")
+
+    if use_copy:
+        db.session.execute(db.text("ANALYZE"))
+
+    start = perf_counter()
+    User.recount()
+    db.session.commit()
+    report("Counted followers, messages and likes", User.query.count(), start)
+
+    start = perf_counter()
+    Message.recount()
+    db.session.commit()
+    report("Counted likes per message", Message.query.count(), start)
+
+    start = perf_counter()
+    restore_indexes = defer_indexes([HomeTimeline.__table__])
+    HomeTimeline.rebuild(app.config['CELEBRITY_FOLLOWER_THRESHOLD'])
+    restore_indexes()
+    db.session.commit()
+    report("Built home timelines", HomeTimeline.query.count(), start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recreate the tables and load sample data from CSVs.")
+    parser.add_argument(
+        "--csv-dir", default="generator",
+        help="directory holding users.csv, messages.csv, follows.csv and "
+             "likes.csv (default: generator)")
+    parser.add_argument(
+        "--batch-size", type=int, default=10000,
+        help="rows per executemany batch when COPY isn't available")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.csv_dir, args.batch_size)
@@ -1,16 +1,21 @@
-const $messageArea = $(".message-area");
-const BASE_URL = "http://127.0.0.1:5001";
-const $likeBtn = $(".btn-like");
+/** How long to wait after a click for more clicks on the same message. */
+const LIKE_COALESCE_MS = 250;
 
-/** Make POST request to like */
-async function likeMessage(messageId) {
-  await axios.post(`${BASE_URL}/messages/${messageId}/like`);
-}
+/** Like state per message id, while the user is clicking its button:
+ *
+ * - confirmed: whether the server last said the message is liked
+ * - confirmedCount: the like count the server last gave
+ * - wanted: whether the user wants it liked (what the icon shows)
+ * - timer: pending send, if the user may still be clicking
+ * - inFlight: whether a request is under way
+ */
+const likeStates = new Map();
 
-/** Get current user's liked messages */
-async function getUserLikes() {
-  const response = await axios.get(`${BASE_URL}/user-likes`);
-  return response.data.userLikes
+/** Make POST request to like or unlike a message; return
+ * {messageId, liked, likeCount} */
+async function setLiked(messageId, liked) {
+  const response = await axios.post(`/messages/${messageId}/like`, { liked });
+  return response.data;
 }
 
 /** Grab target message ID */
@@ -18,32 +23,91 @@ function getMessageId(evt) {
   return $(evt.target).closest(".message-area").data("id");
 }
 
-/** Controller: Handles click for like message click */
-async function handleClickLike(evt) {
-  evt.preventDefault();
-  const msgId = getMessageId(evt);
-  const userLikes = await getUserLikes();
-  await likeMessage(msgId)
-  updateLikeIcon(evt, msgId, userLikes)
+/** Updates UI with like/unlike icons and the like count for a message */
+function showLiked(messageId, state) {
+  const $area = $(`.message-area[data-id="${messageId}"]`);
+  const $icon = $area.find(".btn-like i");
+  $icon.toggleClass("bi-star-fill", state.wanted);
+  $icon.toggleClass("bi-star", !state.wanted);
+
+  // The server's count, adjusted by the click it hasn't seen yet
+  const count = state.confirmedCount + state.wanted - state.confirmed;
+  $area.find(".like-count").text(count);
 }
 
-/** Checks if msg is in users liked messages */
-async function isMsgLiked(msgId, userLikes) {
-  return await userLikes.includes(msgId)
+/** Send the wanted state if it differs from what the server has.
+ *
+ * Only one request per message is in flight at once; clicks made meanwhile
+ * are settled by at most one more request when it returns.
+ */
+async function syncLike(messageId) {
+  const state = likeStates.get(messageId);
+  if (!state) return;
+
+  state.timer = null;
+  if (state.inFlight) return;
+
+  if (state.wanted === state.confirmed) {
+    likeStates.delete(messageId);
+    return;
+  }
+
+  state.inFlight = true;
+
+  try {
+    const { liked, likeCount } = await setLiked(messageId, state.wanted);
+    state.confirmed = liked;
+    state.confirmedCount = likeCount;
+  } catch (err) {
+    // Roll back to what the server last confirmed
+    clearTimeout(state.timer);
+    state.wanted = state.confirmed;
+    showLiked(messageId, state);
+    likeStates.delete(messageId);
+    return;
+  } finally {
+    state.inFlight = false;
+  }
+
+  showLiked(messageId, state);
+
+  if (state.timer === null) {
+    await syncLike(messageId);
+  }
 }
 
-/** Updates UI with like/unlike icons */
-async function updateLikeIcon(evt, msgId, userLikes) {
-  const msgedLiked = await isMsgLiked(msgId, userLikes)
-  let currentIcon = $(evt.target)
-
-  if (msgedLiked) {
-    currentIcon.removeClass("bi-star-fill")
-    currentIcon.addClass("bi-star")
-  } else {
-    currentIcon.removeClass("bi-star")
-    currentIcon.addClass("bi-star-fill")
+/** Controller: Handles click for like message click
+ *
+ * Flips the icon straight away, then sends one request once the clicks on
+ * this message stop.
+ */
+function handleClickLike(evt) {
+  evt.preventDefault();
+
+  const $icon = $(evt.currentTarget).find("i");
+  if (!$icon.length) return;   // your own message
+
+  const messageId = getMessageId(evt);
+  let state = likeStates.get(messageId);
+
+  if (!state) {
+    const liked = $icon.hasClass("bi-star-fill");
+    const $count = $(evt.currentTarget).siblings(".like-count");
+    state = {
+      confirmed: liked,
+      confirmedCount: Number($count.text()) || 0,
+      wanted: liked,
+      timer: null,
+      inFlight: false,
+    };
+    likeStates.set(messageId, state);
   }
+
+  state.wanted = !state.wanted;
+  showLiked(messageId, state);
+
+  clearTimeout(state.timer);
+  state.timer = setTimeout(() => syncLike(messageId), LIKE_COALESCE_MS);
 }
 
-$likeBtn.on("click", handleClickLike);
+$(document).on("click", ".btn-like", handleClickLike);
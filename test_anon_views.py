@@ -4,8 +4,12 @@
 #
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
+import gzip
 import os
+import shutil
+import tempfile
 from unittest import TestCase
+from unittest.mock import patch
 
 from models import db, Message, User, connect_db
 
@@ -18,7 +22,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app
+from app import app, assets
+from assets import build
+from http_caching import static_url
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -257,3 +263,60 @@ class AnonViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.", html)
             self.assertIn("Sign up", html)
+
+    def test_static_caching(self):
+        """Tests that fingerprinted static files may be cached for good and
+        others are revalidated"""
+        # As if `flask assets build` hadn't been run
+        with app.test_request_context(), \
+                patch.object(assets, 'manifest', {}):
+            url = static_url('stylesheets/style.css')
+
+        self.assertIn("?v=", url)
+
+        with self.client as c:
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertEqual(resp.cache_control.max_age, 365 * 24 * 60 * 60)
+            resp.close()
+
+            resp = c.get("/static/stylesheets/style.css")
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertFalse(resp.cache_control.immutable)
+            resp.close()
+
+    def test_built_assets(self):
+        """Tests that built assets have hashed names and are served
+        precompressed when the browser accepts it"""
+        with tempfile.TemporaryDirectory() as static_folder:
+            shutil.copytree(
+                os.path.join(app.static_folder, 'stylesheets'),
+                os.path.join(static_folder, 'stylesheets'))
+            build(static_folder, log=lambda message: None)
+
+            with patch.object(
+                    assets, 'directory', os.path.join(static_folder, 'dist')):
+                assets.load()
+                try:
+                    with app.test_request_context():
+                        url = static_url('stylesheets/style.css')
+
+                    self.assertRegex(
+                        url, r"^/assets/stylesheets/style\.[0-9a-f]{8}\.css$")
+
+                    with self.client as c:
+                        resp = c.get(url, headers={"Accept-Encoding": "gzip"})
+                        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+                        self.assertTrue(resp.cache_control.immutable)
+                        css = gzip.decompress(resp.get_data()).decode()
+                        self.assertIn("#messages", css)
+                        resp.close()
+
+                        resp = c.get(url, headers={"Accept-Encoding": ""})
+                        self.assertNotIn("Content-Encoding", resp.headers)
+                        self.assertEqual(resp.get_data(as_text=True), css)
+                        resp.close()
+                finally:
+                    assets.load()
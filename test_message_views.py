@@ -6,9 +6,13 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db
+from models import db, Message, User, Like, HomeTimeline, connect_db
+from query_budget import assert_query_budget
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -118,3 +122,453 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn("m1-text", html)
 
 
+
+class MessageTimelineViewTestCase(TestCase):
+    def setUp(self):
+        """Set up a user following another user"""
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        u1.following.append(u2)
+        User.recount()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 10000
+        db.session.rollback()
+
+    def post_as(self, c, user_id, text):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return c.post("/messages/new", data={"text": text})
+
+    def home_as(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return c.get("/").get_data(as_text=True)
+
+    def backfill_timelines(self):
+        result = app.test_cli_runner().invoke(args=['backfill-timelines'])
+        self.assertIn("Backfilled home timelines for 1 authors", result.output)
+
+    def test_message_fans_out_to_followers(self):
+        """Tests that a new message is written to follower timelines"""
+        with self.client as c:
+            self.post_as(c, self.u2_id, "fanned out")
+
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 1)
+            self.assertIn("fanned out", self.home_as(c, self.u1_id))
+
+    def test_unfollow_prunes_timeline(self):
+        """Tests that unfollowing removes that user's messages from the feed"""
+        with self.client as c:
+            self.post_as(c, self.u2_id, "soon gone")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 0)
+            self.assertNotIn("soon gone", self.home_as(c, self.u1_id))
+
+    def test_follow_backfills_timeline(self):
+        """Tests that following a user copies their recent messages in"""
+        with self.client as c:
+            self.post_as(c, self.u1_id, "old news")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/users/follow/{self.u1_id}")
+
+            self.assertIn("old news", self.home_as(c, self.u2_id))
+
+    def test_rebuild_timelines_command(self):
+        """Tests that `flask rebuild-timelines` fills in empty timelines"""
+        with self.client as c:
+            self.post_as(c, self.u2_id, "from before the upgrade")
+            HomeTimeline.query.delete()
+            db.session.commit()
+
+            result = app.test_cli_runner().invoke(args=['rebuild-timelines'])
+
+            self.assertIn("Home timelines rebuilt", result.output)
+            self.assertIn(
+                "from before the upgrade", self.home_as(c, self.u1_id))
+
+    def test_celebrity_messages_merged_on_read(self):
+        """Tests that celebrity messages skip fan-out but still show up"""
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 0
+
+        with self.client as c:
+            self.post_as(c, self.u2_id, "famous words")
+
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 0)
+            self.assertIn("famous words", self.home_as(c, self.u1_id))
+
+    def test_former_celebrity_backfilled(self):
+        """Tests that messages posted as a celebrity reach follower
+        timelines once the author drops below the threshold"""
+        app.config['CELEBRITY_FOLLOWER_THRESHOLD'] = 1
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        u4 = User.signup("u4", "u4@email.com", "password", None)
+        db.session.commit()
+        u3_id, u4_id = u3.id, u4.id
+
+        with self.client as c:
+            for user_id in (u3_id, u4_id):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/users/follow/{self.u2_id}")
+
+            self.post_as(c, self.u2_id, "famous words")
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 0)
+
+            # Down to two followers: still a celebrity
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u3_id
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 0)
+
+            # Down to one: merged into the feed until the backfill runs
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u4_id
+            c.post("/users/delete")
+            self.assertIn("famous words", self.home_as(c, self.u1_id))
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 0)
+
+            self.backfill_timelines()
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 1)
+
+            # Up and down again; what's already there isn't copied twice
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u3_id
+            c.post(f"/users/follow/{self.u2_id}")
+            self.post_as(c, self.u2_id, "more famous words")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u3_id
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.backfill_timelines()
+
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 2)
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=u3_id).count(), 0)
+            self.assertIn("famous words", self.home_as(c, self.u1_id))
+
+    def test_timelines_keep_newest_entries(self):
+        """Tests that trimming and rebuilding keep TIMELINE_SIZE entries"""
+        with self.client as c, patch('models.TIMELINE_SIZE', 2):
+            for i in range(3):
+                self.post_as(c, self.u2_id, f"post {i}")
+
+            self.assertEqual(
+                HomeTimeline.query.filter_by(user_id=self.u1_id).count(), 3)
+
+            self.assertEqual(HomeTimeline.trim(), 2)
+            HomeTimeline.rebuild(10000)
+            self.assertEqual(HomeTimeline.trim(), 0)
+
+            for user_id in (self.u1_id, self.u2_id):
+                self.assertEqual(
+                    [text for (text,) in (
+                        db.session.query(Message.text)
+                        .join(HomeTimeline,
+                              HomeTimeline.message_id == Message.id)
+                        .filter(HomeTimeline.user_id == user_id)
+                        .order_by(HomeTimeline.timestamp.desc()))],
+                    ["post 2", "post 1"])
+
+class MessagePaginationViewTestCase(TestCase):
+    def setUp(self):
+        """Set up a user with three messages, two per page"""
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+
+        for i in range(3):
+            db.session.add(Message(
+                text=f"message-{i}",
+                user_id=u1.id,
+                timestamp=datetime(2022, 1, i + 1),
+            ))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 20
+        db.session.rollback()
+
+    def test_profile_pages(self):
+        """Tests that profile messages are split into keyset pages"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/api/users/{self.u1_id}/messages")
+            page = resp.json
+
+            self.assertEqual(
+                [msg["text"] for msg in page["messages"]],
+                ["message-2", "message-1"])
+            self.assertIsNotNone(page["nextCursor"])
+
+            resp = c.get(
+                f"/api/users/{self.u1_id}/messages",
+                query_string={"before": page["nextCursor"]})
+            page = resp.json
+
+            self.assertEqual(
+                [msg["text"] for msg in page["messages"]], ["message-0"])
+            self.assertIsNone(page["nextCursor"])
+
+    def test_liked_pages(self):
+        """Tests that liked messages are paged newest-liked first"""
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        messages = Message.query.order_by(Message.timestamp).all()
+        for day, msg in enumerate(reversed(messages), start=1):
+            db.session.add(Like(
+                user_id=u2.id,
+                message_id=msg.id,
+                created_at=datetime(2022, 2, day)))
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            page = c.get(f"/api/users/{u2_id}/likes").json
+            self.assertEqual(
+                [msg["text"] for msg in page["messages"]],
+                ["message-0", "message-1"])
+
+            page = c.get(
+                f"/api/users/{u2_id}/likes",
+                query_string={"before": page["nextCursor"]}).json
+            self.assertEqual(
+                [msg["text"] for msg in page["messages"]], ["message-2"])
+            self.assertIsNone(page["nextCursor"])
+
+    def test_profile_older_link(self):
+        """Tests that the profile page links to the next page"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+
+            self.assertIn("message-2", html)
+            self.assertNotIn("message-0", html)
+            self.assertIn("Older warbles", html)
+
+    def test_invalid_cursor(self):
+        """Tests that a malformed cursor is rejected"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/api/feed", query_string={"before": "nope"})
+
+            self.assertEqual(resp.status_code, 400)
+
+
+class MessageQueryBudgetTestCase(TestCase):
+    def setUp(self):
+        """Set up a user following three authors with two messages each"""
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        authors = [
+            User.signup(f"author{i}", f"author{i}@email.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.flush()
+
+        for author in authors:
+            u1.following.append(author)
+            for i in range(2):
+                msg = Message(text=f"{author.username}-{i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                HomeTimeline.fan_out(msg, 10000)
+                u1.liked_messages.append(msg)
+
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m_id = msg.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assert_page_within_budget(self, url, budget):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # First request warms the user cache; then start from an empty
+            # identity map so nothing is resolved without a query
+            c.get(url)
+            db.session.expunge_all()
+
+            with assert_query_budget(db.engine, budget):
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_home_feed_budget(self):
+        """Tests that the home feed doesn't load authors one by one"""
+        self.assert_page_within_budget("/", 3)
+
+    def test_liked_messages_budget(self):
+        """Tests that the likes page doesn't load authors one by one"""
+        self.assert_page_within_budget(f"/users/{self.u1_id}/likes", 3)
+
+    def test_message_detail_budget(self):
+        """Tests that the message page loads its author with the message
+        (plus one query for the versions in its ETag)"""
+        self.assert_page_within_budget(f"/messages/{self.m_id}", 4)
+
+    def test_message_detail_not_modified(self):
+        """Tests that a current ETag gets a 304 from a single query"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c.get(f"/messages/{self.m_id}").headers["ETag"]
+
+            with assert_query_budget(db.engine, 1):
+                resp = c.get(f"/messages/{self.m_id}",
+                             headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+
+    def test_metrics(self):
+        """Tests that per-endpoint query counts and timings are exposed"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.content_type.startswith("text/plain"))
+            self.assertIn("# TYPE warbler_request_queries histogram", text)
+            self.assertIn('warbler_request_queries_count{endpoint="homepage"}', text)
+            queries = re.search(
+                r'^warbler_request_queries_sum\{endpoint="homepage"\} (\S+)$',
+                text, re.MULTILINE)
+            self.assertGreater(float(queries[1]), 0)
+            self.assertIn('warbler_request_render_seconds_sum{endpoint="homepage"}', text)
+            self.assertIn('warbler_request_db_seconds_bucket{endpoint="homepage",le="+Inf"}', text)
+
+
+class MessageSearchViewTestCase(TestCase):
+    def setUp(self):
+        """Set up a user with a few messages to search"""
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+
+        db.session.add_all([
+            Message(text="Running late again", user_id=u1.id),
+            Message(text="Went for a run, then a run", user_id=u1.id),
+            Message(text="Nothing to see here", user_id=u1.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 20
+        db.session.rollback()
+
+    def test_search_page(self):
+        """Tests that message search matches word stems"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search", query_string={"q": "runs"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Running late again", html)
+            self.assertIn("Went for a run", html)
+            self.assertNotIn("Nothing to see here", html)
+
+    def test_search_pages_by_rank(self):
+        """Tests that search results are ranked and paged by cursor"""
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            page = c.get("/api/messages/search", query_string={"q": "run"}).json
+            self.assertEqual(
+                page["messages"][0]["text"], "Went for a run, then a run")
+
+            page = c.get(
+                "/api/messages/search",
+                query_string={"q": "run", "before": page["nextCursor"]}).json
+            self.assertEqual(page["messages"][0]["text"], "Running late again")
+            self.assertIsNone(page["nextCursor"])
+
+    def test_search_pages_through_equal_ranks(self):
+        """Tests that paging through many equally ranked results shows each
+        once"""
+        db.session.add_all([
+            Message(text=f"Morning run number {i}", user_id=self.u1_id)
+            for i in range(25)
+        ])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 4
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            cursor = None
+            for _ in range(20):
+                page = c.get(
+                    "/api/messages/search",
+                    query_string={"q": "morning run", "before": cursor}).json
+                seen += [message["id"] for message in page["messages"]]
+                cursor = page["nextCursor"]
+                if cursor is None:
+                    break
+
+            self.assertEqual(len(seen), 25)
+            self.assertEqual(len(set(seen)), 25)
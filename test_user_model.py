@@ -6,9 +6,13 @@
 
 
 import os
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, connect_db
+from models import db, User, Message, Follows, connect_db, hasher
+from passwords import PasswordHasher, HasherBusy
 from sqlalchemy import exc
 
 # BEFORE we import our app, let's set an environmental variable
@@ -68,6 +72,48 @@ class UserModelTestCase(TestCase):
         self.assertTrue(u1.is_following(u2))
         self.assertFalse(u2.is_following(u1))
 
+    def test_following_ids_among(self):
+        """Tests that follows are resolved for a batch of users at once"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(
+            u1.following_ids_among([self.u1_id, self.u2_id]), {self.u2_id})
+        self.assertEqual(u2.following_ids_among([self.u1_id]), set())
+        self.assertTrue(u1.snapshot().is_following(u2))
+
+    def test_add_follow_without_on_conflict(self):
+        """Tests adding follows on a database without ON CONFLICT"""
+        with patch.object(db.engine.dialect, 'name', 'mysql'):
+            self.assertTrue(Follows.add(self.u1_id, self.u2_id))
+            self.assertFalse(Follows.add(self.u1_id, self.u2_id))
+            self.assertFalse(Follows.add(self.u1_id, 0))
+
+        self.assertTrue(User.query.get(self.u1_id).is_following(
+            User.query.get(self.u2_id)))
+
+    def test_recount(self):
+        """Tests that recount rebuilds counters from the source tables"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        u1.messages.append(Message(text="counted"))
+        db.session.commit()
+
+        self.assertEqual(u1.messages_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.following_count, 0)
+
     def test_is_followed_by(self):
         """Tests that is_followed_by method displays followed by properly"""
         u1 = User.query.get(self.u1_id)
@@ -120,3 +166,42 @@ class UserModelTestCase(TestCase):
 
 
 
+
+    def test_rehash_on_login(self):
+        """Tests that logging in upgrades a hash made with an old work factor"""
+        log_rounds = hasher.log_rounds
+        hasher.log_rounds = 4
+        try:
+            u1 = User.authenticate("u1", "password")
+            self.assertTrue(u1.password.startswith("$2b$04$"))
+            self.assertFalse(hasher.needs_rehash(u1.password))
+            self.assertEqual(User.authenticate("u1", "password"), u1)
+        finally:
+            hasher.log_rounds = log_rounds
+
+    def test_hasher_busy(self):
+        """Tests that hashing is refused while every queue slot is taken"""
+        busy = PasswordHasher()
+        busy.workers = 1
+        busy.queue_timeout = 0
+        busy._slots = BoundedSemaphore(1)
+        busy._slots.acquire()
+
+        with self.assertRaises(HasherBusy):
+            busy.hash("password")
+
+    def test_hasher_replaces_broken_pool(self):
+        """Tests that hashing starts a new pool when a worker has died"""
+        hasher = PasswordHasher()
+        hasher.workers = 1
+        hasher.log_rounds = 4
+        hasher._slots = BoundedSemaphore(1)
+
+        broken = hasher._get_pool()
+        with self.assertRaises(BrokenProcessPool):
+            broken.submit(os._exit, 1).result()
+
+        hashed = hasher.hash("password")
+        self.assertTrue(hasher.check(hashed, "password"))
+        self.assertIsNot(hasher._pool, broken)
+        hasher._pool.shutdown()
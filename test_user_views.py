@@ -5,10 +5,16 @@
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
 
+import json
 import os
+import tempfile
 from unittest import TestCase
-from models import db, Message, User, connect_db
+from unittest.mock import patch
+from caching import LRUCache, MemoryBackend, TieredCache
+from like_buffer import LikeBuffer
+from models import db, Message, User, CachedUser, Like, connect_db
 from flask import session
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +25,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import (
+    app, CURR_USER_KEY, rate_limit_store, login_username_limiter,
+    forget_likes, get_cached_user)
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -46,6 +54,7 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Set up users and messages"""
         User.query.delete()
+        rate_limit_store.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -141,6 +150,95 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Invalid credentials.", html)
 
+    def test_login_rate_limited_by_username(self):
+        """Tests that repeated failed logins for a username are turned away"""
+        data = {'username': 'u1', 'password': 'wrongpassword'}
+
+        with self.client as c:
+            # base.html needs g.new_message_form, which is only set for a
+            # logged-in session
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for _ in range(login_username_limiter.capacity):
+                resp = c.post("/login", data=data)
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/login", data={'username': 'u1', 'password': 'password'})
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Too many login attempts", resp.get_data(as_text=True))
+
+    def test_login_rate_limit_checks_ip_first(self):
+        """Tests that logins turned away by IP don't create username
+        buckets"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for i in range(app.config['LOGIN_IP_CAPACITY'] + 5):
+                c.post("/login",
+                       data={'username': f'nobody{i}', 'password': 'x'})
+
+        self.assertFalse(login_username_limiter.blocked('u1'))
+        buckets = rate_limit_store._buckets
+        self.assertLessEqual(
+            sum(key.startswith('login-username:') for key in buckets),
+            app.config['LOGIN_IP_CAPACITY'])
+
+    def test_login_rate_limit_behind_proxy(self):
+        """Tests that behind a trusted proxy logins are limited by the
+        forwarded client IP, and that the header is ignored otherwise"""
+        def logins_from(ip):
+            return [
+                c.post("/login",
+                       data={'username': f'nobody{i}',
+                             'password': 'wrongpassword'},
+                       headers={'X-Forwarded-For': ip}).status_code
+                for i in range(app.config['LOGIN_IP_CAPACITY'])]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertNotIn(429, logins_from('10.0.0.1'))
+            self.assertIn(429, logins_from('10.0.0.2'))
+
+        rate_limit_store.clear()
+        with patch.object(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1)), \
+                self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertNotIn(429, logins_from('10.0.0.1'))
+            self.assertNotIn(429, logins_from('10.0.0.2'))
+            self.assertIn(429, logins_from('10.0.0.1'))
+
+    def test_unknown_username_cached(self):
+        """Tests that unknown usernames are remembered (in the shared cache)
+        until signup"""
+        unknown_usernames = TieredCache(
+            LRUCache(ttl=60), shared=MemoryBackend(),
+            prefix='unknown-username:', dumps=json.dumps, loads=json.loads)
+
+        with self.client as c, \
+                patch('app.unknown_usernames', unknown_usernames):
+            # base.html needs g.new_message_form, which is only set for a
+            # logged-in session
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post("/login", data={'username': 'u9', 'password': 'password'})
+            self.assertIn("Invalid credentials.", resp.get_data(as_text=True))
+            self.assertTrue(unknown_usernames.get('u9'))
+
+            c.post("/signup",
+                data={
+                    'username': 'u9',
+                    'email': 'u9@email.com',
+                    'password': 'password',
+                })
+            self.assertIsNone(unknown_usernames.get('u9'))
+
     def test_logout(self):
         """Tests that user can logout properly"""
         with self.client as c:
@@ -200,6 +298,43 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Sorry, no users found", html)
 
+    def test_users_pages(self):
+        """Tests that the user directory is paged in username order"""
+        app.config['USERS_PER_PAGE'] = 2
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users").get_data(as_text=True)
+            app.config['USERS_PER_PAGE'] = 30
+
+            self.assertIn("@u1", html)
+            self.assertIn("@u2", html)
+            self.assertNotIn("@u3", html)
+            self.assertIn("after=u2", html)
+
+            html = c.get(
+                "/users",
+                query_string={'after': 'u2'}).get_data(as_text=True)
+
+            self.assertIn("@u3", html)
+            self.assertNotIn("@u1", html)
+
+    def test_users_typeahead(self):
+        """Tests that typeahead returns users by username prefix"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/api/users/typeahead", query_string={'q': 'u'})
+            self.assertEqual(
+                [user["username"] for user in resp.json["users"]],
+                ["u1", "u2", "u3"])
+
+            resp = c.get("/api/users/typeahead", query_string={'q': '%'})
+            self.assertEqual(resp.json["users"], [])
+
     #this is for search query
     def test_display_user_profile(self):
         """Tests that user can view user profile properly"""
@@ -257,6 +392,97 @@ class UserViewTestCase(TestCase):
             self.assertIn("@u3", html)
             #test length of following list
 
+    def test_follow_counters(self):
+        """Tests that following updates both users' counters"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u3_id}")
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u3_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u3_id}")
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u3_id).followers_count, 0)
+
+    def test_follow_twice(self):
+        """Tests that following someone again changes nothing"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u3_id}")
+            resp = c.post(f"/users/follow/{self.u3_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.u3_id).followers_count, 1)
+
+            resp = c.post("/users/follow/0")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_follow_json(self):
+        """Tests that the JSON follow endpoints return the new state"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/api/users/follow/{self.u3_id}")
+            self.assertEqual(resp.json, {"userId": self.u3_id, "following": True})
+            self.assertTrue(User.query.get(self.u1_id).is_following(
+                User.query.get(self.u3_id)))
+
+            resp = c.post(f"/api/users/stop-following/{self.u3_id}")
+            self.assertEqual(resp.json, {"userId": self.u3_id, "following": False})
+            self.assertEqual(User.query.get(self.u3_id).followers_count, 0)
+
+    def test_delete_user_counters(self):
+        """Tests that deleting an account updates other users' counters"""
+        User.recount()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/users/delete")
+
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+            self.assertEqual(User.query.get(self.u3_id).following_count, 0)
+
+    def test_delete_user_refreshes_others(self):
+        """Tests that deleting an account drops the cached snapshots of the
+        users whose counters it changed"""
+        User.recount()
+        db.session.commit()
+        self.assertEqual(get_cached_user(self.u3_id).following_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/users/delete")
+
+        self.assertEqual(get_cached_user(self.u3_id).following_count, 0)
+
+    def test_shared_cache_deletes(self):
+        """Tests that a delete through a shared cache reaches every
+        process's view of it"""
+        shared = MemoryBackend()
+        ours, theirs = (
+            TieredCache(LRUCache(ttl=300), shared=shared, prefix='user:',
+                        dumps=CachedUser.to_json, loads=CachedUser.from_json)
+            for _ in range(2))
+
+        snapshot = User.query.get(self.u1_id).snapshot()
+        theirs.set(self.u1_id, snapshot)
+        self.assertEqual(theirs.get(self.u1_id), snapshot)
+
+        ours.delete(self.u1_id)
+        self.assertIsNone(theirs.get(self.u1_id))
+
     def test_stop_following(self):
         """Tests that unfollowing another user works properly"""
         with self.client as c:
@@ -290,6 +516,77 @@ class UserViewTestCase(TestCase):
             self.assertIn("Information successfully updated.", html)
             self.assertIn("California", html)
 
+    def test_cached_user(self):
+        """Tests that the logged in user is served from the cache until
+        their profile is edited"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            User.query.filter_by(id=self.u1_id).update({"username": "renamed"})
+            db.session.commit()
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@u1", html)
+
+            c.post("/users/profile", data={
+                'username': 'edited',
+                'email': 'u1@email.com',
+                'password': 'password',
+            })
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@edited", html)
+
+    def test_cached_message_cards(self):
+        """Tests that message cards are reused until their author's profile
+        is edited"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u1_id}")
+            User.query.filter_by(id=self.u1_id).update({"username": "renamed"})
+            db.session.commit()
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{self.u1_id}">@u1</a>', html)
+
+            c.post("/users/profile", data={
+                'username': 'edited',
+                'email': 'u1@email.com',
+                'password': 'password',
+            })
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{self.u1_id}">@edited</a>', html)
+            self.assertNotIn("@u1<", html)
+
+    def test_profile_etag(self):
+        """Tests that an unchanged profile answers a conditional GET with a
+        304, and a change to it or the viewer gives a new page"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertTrue(resp.cache_control.private)
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            c.post(f"/messages/{self.m1_id}/like")
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
     def test_invalid_update_profile(self):
         """Tests that user cannot update their profile with incorrect password properly"""
         with self.client as c:
@@ -342,6 +639,252 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("bi-star-fill", html)
 
+    def test_toggle_like_state(self):
+        """Tests that toggling a like returns the new state and count"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.json, {
+                "messageId": self.m1_id, "liked": True, "likeCount": 1})
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.json, {
+                "messageId": self.m1_id, "liked": False, "likeCount": 0})
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+            resp = c.post(f"/messages/{self.m2_id}/like")
+            self.assertEqual(resp.status_code, 403)
+
+            resp = c.post("/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_likes_after_toggle(self):
+        """Tests that the cached liked ids are refreshed after a like"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/user-likes")
+            self.assertEqual(resp.json["userLikes"], [])
+
+            c.post(f"/messages/{self.m1_id}/like")
+
+            resp = c.get("/user-likes")
+            self.assertEqual(resp.json["userLikes"], [self.m1_id])
+
+    def test_user_likes_across_processes(self):
+        """Tests that a like refreshes the liked ids cached by other
+        processes sharing the cache"""
+        shared = MemoryBackend()
+        ours, theirs = (
+            TieredCache(LRUCache(ttl=60), shared=shared, prefix='liked-ids:',
+                        dumps=lambda ids: json.dumps(sorted(ids)),
+                        loads=lambda data: frozenset(json.loads(data)))
+            for _ in range(2))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with patch('app.liked_ids_cache', theirs):
+                resp = c.get("/user-likes")
+                self.assertEqual(resp.json["userLikes"], [])
+
+            with patch('app.liked_ids_cache', ours):
+                c.post(f"/messages/{self.m1_id}/like")
+
+            with patch('app.liked_ids_cache', theirs):
+                resp = c.get("/user-likes")
+                self.assertEqual(resp.json["userLikes"], [self.m1_id])
+
+    def test_write_behind_likes(self):
+        """Tests that buffered likes are seen at once, journaled and
+        written in a batch"""
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        config = {
+            'LIKE_WRITE_BEHIND': True,
+            'LIKE_FLUSH_INTERVAL': 3600,
+            'LIKE_JOURNAL_DIR': journal_dir.name,
+        }
+
+        with patch.dict(app.config, config), patch.dict(app.extensions):
+            buffer = LikeBuffer(app, on_flushed=forget_likes)
+
+        def likes_in_db():
+            return Like.query.filter_by(user_id=self.u1_id).count()
+
+        with self.client as c, patch('app.like_buffer', buffer):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.status_code, 400)
+
+            for liked in (True, False, True):
+                resp = c.post(f"/messages/{self.m1_id}/like",
+                              json={"liked": liked})
+                self.assertEqual(resp.json, {
+                    "messageId": self.m1_id,
+                    "liked": liked,
+                    "likeCount": int(liked)})
+
+            self.assertEqual(likes_in_db(), 0)
+            resp = c.get("/user-likes")
+            self.assertEqual(resp.json["userLikes"], [self.m1_id])
+
+            # A restarted process picks the intent up from the journal
+            with patch.dict(app.config, config), patch.dict(app.extensions):
+                restarted = LikeBuffer(app, on_flushed=forget_likes)
+            self.assertEqual(restarted.pending_for(self.u1_id),
+                             {self.m1_id: True})
+
+            self.assertEqual(buffer.flush(), 1)
+            self.assertEqual(likes_in_db(), 1)
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            # Writing the same intent again changes nothing
+            self.assertEqual(restarted.flush(), 1)
+            self.assertEqual(likes_in_db(), 1)
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            resp = c.get("/user-likes")
+            self.assertEqual(resp.json["userLikes"], [self.m1_id])
+
+    def test_write_behind_likes_across_processes(self):
+        """Tests that the last like or unlike wins, whichever process
+        writes its buffer first"""
+        for flush_order in ((0, 1), (1, 0)):
+            buffers = []
+            for _ in range(2):
+                journal_dir = tempfile.TemporaryDirectory()
+                self.addCleanup(journal_dir.cleanup)
+                config = {
+                    'LIKE_WRITE_BEHIND': True,
+                    'LIKE_FLUSH_INTERVAL': 3600,
+                    'LIKE_JOURNAL_DIR': journal_dir.name,
+                }
+                with patch.dict(app.config, config), \
+                        patch.dict(app.extensions):
+                    buffers.append(LikeBuffer(app, on_flushed=forget_likes))
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                # Like through one process, then unlike through the other
+                for buffer, liked in zip(buffers, (True, False)):
+                    with patch('app.like_buffer', buffer):
+                        resp = c.post(f"/messages/{self.m1_id}/like",
+                                      json={"liked": liked})
+                        self.assertEqual(resp.json["liked"], liked)
+
+                for i in flush_order:
+                    buffers[i].flush()
+
+                self.assertEqual(
+                    Like.query.filter_by(user_id=self.u1_id).count(), 0)
+                self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+                self.assertEqual(Message.query.get(self.m1_id).like_count, 0)
+
+    def test_set_like_state(self):
+        """Tests that sending the state wanted twice changes nothing"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.m1_id}/like",
+                              json={"liked": True})
+                self.assertEqual(resp.json, {
+                    "messageId": self.m1_id, "liked": True, "likeCount": 1})
+                self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            resp = c.post(f"/messages/{self.m1_id}/like", json={"liked": 1})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_message_like_count(self):
+        """Tests that like counts are kept on messages and shown on cards"""
+        with self.client as c:
+            for user_id in (self.u1_id, self.u3_id):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(Message.query.get(self.m1_id).like_count, 2)
+
+            resp = c.get(f"/users/{self.u2_id}")
+            self.assertIn('class="like-count text-muted">2</a>',
+                          resp.get_data(as_text=True))
+
+            c.post("/users/delete")
+            self.assertEqual(Message.query.get(self.m1_id).like_count, 1)
+
+    def test_likers(self):
+        """Tests that the users who liked a message are listed a page at a
+        time"""
+        with self.client as c:
+            for user_id in (self.u3_id, self.u1_id):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/messages/{self.m1_id}/like")
+
+            with patch.dict(app.config, {'USERS_PER_PAGE': 1}):
+                resp = c.get(f"/api/messages/{self.m1_id}/likers")
+                first = min(self.u1_id, self.u3_id)
+                self.assertEqual(
+                    [user["id"] for user in resp.json["users"]], [first])
+                self.assertEqual(resp.json["nextAfter"], first)
+
+                resp = c.get(f"/api/messages/{self.m1_id}/likers",
+                             query_string={"after": first})
+                self.assertEqual(
+                    [user["id"] for user in resp.json["users"]],
+                    [max(self.u1_id, self.u3_id)])
+                self.assertIsNone(resp.json["nextAfter"])
+
+                resp = c.get(f"/messages/{self.m1_id}/likers")
+                self.assertIn(
+                    f'href="/messages/{self.m1_id}/likers?after={first}"',
+                    resp.get_data(as_text=True))
+
+            resp = c.get(f"/messages/{self.m1_id}/likers")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@u1", html)
+            self.assertIn("@u3", html)
+            self.assertNotIn('id="more-users"', html)
+
+            resp = c.get(f"/api/messages/{self.m1_id}/likers",
+                         query_string={"after": "x"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/api/messages/0/likers")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_likes_among_ids(self):
+        """Tests that liked ids can be looked up for just some messages"""
+        u1 = User.query.get(self.u1_id)
+        u1.liked_messages.append(Message.query.get(self.m1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(
+                "/user-likes",
+                query_string={"ids": f"{self.m1_id},{self.m2_id}"})
+            self.assertEqual(resp.json["userLikes"], [self.m1_id])
+
+            resp = c.get("/user-likes", query_string={"ids": str(self.m2_id)})
+            self.assertEqual(resp.json["userLikes"], [])
+
+            resp = c.get("/user-likes", query_string={"ids": "x"})
+            self.assertEqual(resp.status_code, 400)
+
     def test_unlike_message(self):
         """Tests that user can unlike message properly"""
         u1 = User.query.get(self.u1_id)